@@ -0,0 +1,36 @@
+import asyncio
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class AsyncPhotoPrismClient:
+    """
+    asyncio front end to the PhotoPrism helpers in utils.
+
+    Each call runs the blocking helper on a worker thread over the shared
+    pooled session, so connections are reused exactly as in the synchronous
+    worker, while the semaphore caps the number of requests in flight.
+    """
+
+    def __init__(self, in_flight=8):
+        self.semaphore = asyncio.Semaphore(max(1, in_flight))
+
+    async def run(self, func, *args):
+        """Run a blocking function in a thread, counted against the in-flight limit"""
+        async with self.semaphore:
+            return await asyncio.to_thread(func, *args)
+
+    async def prefetch(self, pages):
+        """
+        Iterate a blocking page iterator, fetching the next page in the
+        background while the caller processes the current one.
+        """
+        iterator = iter(pages)
+        pending = asyncio.ensure_future(asyncio.to_thread(next, iterator, None))
+        while True:
+            page = await pending
+            if page is None:
+                return
+            pending = asyncio.ensure_future(asyncio.to_thread(next, iterator, None))
+            yield page
@@ -0,0 +1,224 @@
+import os
+import sys
+import time
+import json
+import types
+import runpy
+import argparse
+import resource
+import tempfile
+import threading
+import numpy as np
+import photoprism_stub
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Run worker.py against a local PhotoPrism stub serving a directory of sample
+# images, and report photos/sec, per-stage latency percentiles, database round
+# trips and peak RSS. Settings are passed as KEY=VALUE pairs, so batch sizes,
+# backends and concurrency can be compared without touching .env:
+#
+#   uv run benchmark.py ./sample_images --copies 20 --mock-models PIPELINE=1 CAPTION_BATCH_SIZE=8
+
+parser = argparse.ArgumentParser(description="Benchmark the worker against a local PhotoPrism stub")
+parser.add_argument("image_dir")
+parser.add_argument("settings", nargs="*", metavar="KEY=VALUE", help="Environment overrides for the worker")
+parser.add_argument("--copies", type=int, default=1, help="List every image this many times")
+parser.add_argument("--mock-models", action="store_true",
+                    help="Replace the caption and YOLO models with mocks, to measure everything but inference")
+parser.add_argument("--mock-caption-latency", type=float, default=0.02, help="Seconds per image of the mock caption model")
+parser.add_argument("--mock-classify-latency", type=float, default=0.002, help="Seconds per image of the mock classifier")
+parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+parser.add_argument("--verbose", action="store_true", help="Show the worker logs")
+args = parser.parse_intermixed_args()
+
+
+class Timings:
+    """Latency samples per stage, recorded from any thread"""
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def wrap(self, name, func):
+        def timed(*func_args, **func_kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*func_args, **func_kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timed
+
+    def report(self):
+        with self.lock:
+            return {
+                name: {
+                    "count": len(samples),
+                    "p50_ms": round(float(np.percentile(samples, 50)) * 1000, 2),
+                    "p95_ms": round(float(np.percentile(samples, 95)) * 1000, 2),
+                    "p99_ms": round(float(np.percentile(samples, 99)) * 1000, 2),
+                    "total_s": round(sum(samples), 2),
+                }
+                for name, samples in self.samples.items()
+            }
+
+
+class MockModel:
+    """Stands in for a model, sleeping latency seconds per image"""
+
+    input_size = 224
+    model_version = "mock"
+
+    def __init__(self, *model_args, **model_kwargs):
+        self.model_name = f"mock-{type(self).__name__}"
+
+    def preprocess_spec(self):
+        return {"shortest_edge": self.input_size, "crop": (self.input_size, self.input_size),
+                "rescale": 1 / 255, "mean": [0.5] * 3, "std": [0.5] * 3}
+
+
+class MockDescriptionGenerator(MockModel):
+    def generate(self, images=None, pixel_values=None):
+        batch = images if images is not None else pixel_values
+        time.sleep(args.mock_caption_latency * len(batch))
+        return [f"A mock caption of brightness {float(np.mean(image)):.3f}" for image in batch]
+
+
+class MockClassifier(MockModel):
+    def classify(self, images=None, pixel_values=None):
+        batch = images if images is not None else pixel_values
+        time.sleep(args.mock_classify_latency * len(batch))
+        return [["mock"] for _ in batch]
+
+
+logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+server = photoprism_stub.serve(args.image_dir, copies=args.copies)
+library = server.RequestHandlerClass.library
+if not library.photos:
+    logger.error(f"No images found in {args.image_dir}")
+    sys.exit(-1)
+
+# The worker gets a fresh database and result cache unless told otherwise
+workdir = tempfile.mkdtemp(prefix="photo-ai-benchmark-")
+os.environ.update({
+    "PHOTOPRISM_ROOT_URL": f"http://{server.server_address[0]}:{server.server_address[1]}",
+    "PHOTOPRISM_TOKEN": "benchmark",
+    "DISTRIBUTED_PROCESSING": "0",
+    "DB_PATH": os.path.join(workdir, "photo_tasks.db"),
+    "RESULT_CACHE_PATH": os.path.join(workdir, "result_cache.db"),
+    "NODE_NAME": "benchmark",
+    "FULL_SCAN": "true",
+})
+for setting in args.settings:
+    key, _, value = setting.partition("=")
+    os.environ[key] = value
+
+# Imported once the environment is in place, as constants is read at import
+import utils
+import constants
+import preprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Settings must not point the run at a real job database, it would process or complete real tasks
+if constants.DP or os.path.dirname(os.path.abspath(constants.DB_PATH)) != workdir:
+    logger.error("Only runs on its own scratch SQLite job database, do not set DISTRIBUTED_PROCESSING or DB_PATH")
+    sys.exit(-1)
+
+timings = Timings()
+round_trips = {}
+round_trips_lock = threading.Lock()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_round_trip(conn, cursor, statement, parameters, context, executemany):
+    name = os.path.basename(conn.engine.url.database or str(conn.engine.url))
+    with round_trips_lock:
+        round_trips[name] = round_trips.get(name, 0) + 1
+
+utils.get_photos = timings.wrap("list", utils.get_photos)
+utils.get_photo = timings.wrap("get", utils.get_photo)
+utils.download_image = timings.wrap("download", utils.download_image)
+utils.download_image_buffer = timings.wrap("download", utils.download_image_buffer)
+utils.update_photo_detail = timings.wrap("update", utils.update_photo_detail)
+preprocess.prepare_inputs = timings.wrap("decode", preprocess.prepare_inputs)
+preprocess.Preprocessor.collect = timings.wrap("decode", preprocess.Preprocessor.collect)
+
+if args.mock_models:
+    detection = types.ModuleType("detection")
+    detection.Florence2DescriptionGenerator = MockDescriptionGenerator
+    detection.Kosmos2DescriptionGenerator = MockDescriptionGenerator
+    detection.Classifier = MockClassifier
+    sys.modules["detection"] = detection
+else:
+    import detection
+
+for generator_class in {detection.Florence2DescriptionGenerator, detection.Kosmos2DescriptionGenerator}:
+    generator_class.generate = timings.wrap("caption", generator_class.generate)
+detection.Classifier.classify = timings.wrap("classify", detection.Classifier.classify)
+
+# Processing starts once both models are loaded, the classifier is loaded last
+loaded = {}
+classifier_init = detection.Classifier.__init__
+def init_classifier(self, *init_args, **init_kwargs):
+    classifier_init(self, *init_args, **init_kwargs)
+    loaded["at"] = time.perf_counter()
+detection.Classifier.__init__ = init_classifier
+
+def run_script(name):
+    """Run one of the repo's scripts in this process, returns its exit code"""
+    try:
+        runpy.run_path(os.path.join(os.path.dirname(os.path.abspath(__file__)), name), run_name="__main__")
+    except SystemExit as e:
+        return e.code or 0
+    return 0
+
+# Queue mode workers claim tasks, so the queue is seeded first and outside the measurement
+exit_code = 0
+if constants.QUEUE_MODE:
+    exit_code = run_script("seed.py")
+    timings.samples.clear()
+    round_trips.clear()
+
+start_time = time.perf_counter()
+if not exit_code:
+    exit_code = run_script("worker.py")
+end_time = time.perf_counter()
+
+processing_time = end_time - loaded.get("at", start_time)
+usage = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+rss_unit = 1 if sys.platform == "darwin" else 1024
+report = {
+    "settings": dict(setting.partition("=")[::2] for setting in args.settings),
+    "mock_models": args.mock_models,
+    "exit_code": exit_code,
+    "photos": len(library.photos),
+    "updated": library.updates,
+    "model_load_s": round(loaded.get("at", start_time) - start_time, 2),
+    "processing_s": round(processing_time, 2),
+    "photos_per_second": round(library.updates / max(processing_time, 1e-9), 2),
+    "stages": timings.report(),
+    "db_round_trips": round_trips,
+    "peak_rss_mb": round(usage[0] * rss_unit / 2 ** 20, 1),
+    "peak_child_rss_mb": round(usage[1] * rss_unit / 2 ** 20, 1),
+}
+server.shutdown()
+
+if args.json:
+    print(json.dumps(report, indent=2))
+else:
+    print(f"{report['updated']}/{report['photos']} photos in {report['processing_s']}s "
+          f"({report['photos_per_second']} photos/s), models loaded in {report['model_load_s']}s")
+    for name, stage in report["stages"].items():
+        print(f"  {name:<9} {stage['count']:>6} calls  p50 {stage['p50_ms']:>9.2f}ms  "
+              f"p95 {stage['p95_ms']:>9.2f}ms  p99 {stage['p99_ms']:>9.2f}ms  total {stage['total_s']}s")
+    for name, count in report["db_round_trips"].items():
+        print(f"  {name}: {count} round trips ({count / max(report['updated'], 1):.1f} per photo)")
+    print(f"  peak RSS {report['peak_rss_mb']} MB, child processes {report['peak_child_rss_mb']} MB")
+sys.exit(exit_code)
@@ -11,8 +11,30 @@ bool_t = lambda x: x.lower() in ['true', 'yes', '1']
 PHOTOPRISM_ROOT_URL = os.environ.get('PHOTOPRISM_ROOT_URL')  # Base URL for Photoprism
 PHOTOPRISM_PHOTO_API = os.environ.get('PHOTOPRISM_PHOTO_API', "/api/v1/photos")  # API endpoint for photos
 PHOTOPRISM_DL_API = os.environ.get('PHOTOPRISM_DL_API', "/api/v1/dl/{hash}")  # API endpoint for downloading photos
+PHOTOPRISM_THUMB_API = os.environ.get('PHOTOPRISM_THUMB_API', "/api/v1/t/{hash}/{token}/{size}")  # API endpoint for thumbnails
 PHOTOPRISM_TOKEN = os.environ.get('PHOTOPRISM_TOKEN')  # Authentication token for Photoprism
 
+# Filter applied when listing photos, edit to match your filtering needs (Advance)
+PHOTO_FILTER = {
+    "order": "added",
+    "photo": True,
+    "primary": True,
+}
+
+# Prompt and generation budget of each caption model, select one with CAPTION_PROFILE (Advance)
+# num_beams 1 is greedy decoding, beam search multiplies the decoder compute by num_beams
+GENERATION_PROFILES = {
+    "florence2": {
+        "fast": {"prompt": "<CAPTION>", "max_new_tokens": 64, "num_beams": 1},
+        "balanced": {"prompt": "<DETAILED_CAPTION>", "max_new_tokens": 256, "num_beams": 3, "early_stopping": True},
+        "detailed": {"prompt": "<MORE_DETAILED_CAPTION>", "max_new_tokens": 1024, "num_beams": 3},
+    },
+    "kosmos2": {
+        "fast": {"prompt": "An image of", "max_new_tokens": 32, "num_beams": 1},
+        "detailed": {"prompt": "An image of", "max_new_tokens": 128, "num_beams": 1},
+    },
+}
+
 # Distributed processing configuration
 DP = bool_t(os.environ.get('DISTRIBUTED_PROCESSING', '0'))  # Enable or disable distributed processing
 
@@ -27,24 +49,129 @@ else:
     # Local database file path
     DB_PATH = os.environ.get('DB_PATH', 'photo_tasks.db')  # Path to local SQLite database
 
+# SQLite job database tuning, for one or several workers sharing the file on a single node
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')  # WAL lets workers read while another one writes, DELETE for the SQLite default
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')  # NORMAL syncs at WAL checkpoints rather than on every commit, FULL for the SQLite default
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 30))  # Seconds a worker waits for the write lock held by another one
+
+# Completed and failed tasks are committed together every JOB_COMMIT_INTERVAL seconds
+JOB_COMMIT_INTERVAL = float(os.environ.get('JOB_COMMIT_INTERVAL', 0))  # Seconds completions are buffered before one commit, 0 to commit them right away
+
+# Result cache, maps photo content hashes to the results of each model
+RESULT_CACHE = bool_t(os.environ.get('RESULT_CACHE', '0'))  # Reuse cached results instead of downloading and inferring again
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', 'result_cache.db')  # Path to the local SQLite result cache
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 1000000))  # Least recently used results are evicted above this count
+
+# Near-duplicate reuse, burst shots and edited copies reuse the results of a recent photo with a close perceptual hash
+NEAR_DUPLICATE = bool_t(os.environ.get('NEAR_DUPLICATE', '0'))  # Reuse the results of recent near-identical photos instead of inferring again
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_DISTANCE', 4))  # Max differing bits of the 64 bit perceptual hashes of near-duplicates
+NEAR_DUPLICATE_INDEX_SIZE = int(os.environ.get('NEAR_DUPLICATE_INDEX_SIZE', 10000))  # Number of recent results kept in the near-duplicate index
+
 # Node configuration
 NODE_NAME = os.environ.get('NODE_NAME')  # Name of the processing node
 
 # Temporary directory for photo storage
 TEMP_PHOTO_DIR = os.environ.get('TEMP_PHOTO_DIR', tempfile.gettempdir())
+IN_MEMORY_DOWNLOAD = bool_t(os.environ.get('IN_MEMORY_DOWNLOAD', '0'))  # Download photos into memory instead of TEMP_PHOTO_DIR
+IN_MEMORY_MAX_BYTES = int(os.environ.get('IN_MEMORY_MAX_BYTES', 64 * 1024 * 1024))  # Larger downloads spill over to TEMP_PHOTO_DIR
+
+# Image source configuration
+IMAGE_SOURCE = os.environ.get('IMAGE_SOURCE', 'original')  # 'original' downloads the original file, 'thumbnail' a PhotoPrism thumbnail
+THUMBNAIL_SIZE = os.environ.get('THUMBNAIL_SIZE', '')  # Thumbnail size e.g. fit_1280, picked from the models input size when empty
+DECODE_DRAFT = bool_t(os.environ.get('DECODE_DRAFT', '0'))  # Decode JPEGs at a reduced scale still covering the models input size
+
+# Listing configuration
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))  # Photos listed per PhotoPrism request
+PAGE_PREFETCH = int(os.environ.get('PAGE_PREFETCH', 1))  # Pages listed ahead of the one being processed, 0 to disable
 
 # Scanning and model configuration
 FULL_SCAN = bool_t(os.environ.get('FULL_SCAN', '0'))  # Enable or disable full scan mode
 CAPTION_MODEL = os.environ.get('CAPTION_MODEL', 'florence2')  # Default captioning model
 KOSMOS2_MODEL = os.environ.get('KOSMOS2_MODEL', 'microsoft/kosmos-2-patch14-224')  # Kosmos-2 model
 FLORENCE2_MODEL = os.environ.get('FLORENCE2_MODEL', "microsoft/Florence-2-base")  # Florence-2 model
-CAPTION_BATCH_SIZE = int(os.environ.get('CAPTION_BATCH_SIZE', 1))  # Batch size for captioning
+CAPTION_PROFILE = os.environ.get('CAPTION_PROFILE', 'detailed')  # Generation profile of the caption model, see GENERATION_PROFILES
+REPASS_PROFILE = os.environ.get('REPASS_PROFILE', '')  # Re-caption the photos captioned with this profile using CAPTION_PROFILE
+CAPTION_BATCH_SIZE = int(os.environ.get('CAPTION_BATCH_SIZE', 1))  # Batch size for captioning, initial batch size with ADAPTIVE_BATCH
+ADAPTIVE_BATCH = bool_t(os.environ.get('ADAPTIVE_BATCH', '0'))  # Resize caption batches to fit the latency and memory budgets
+CAPTION_MAX_BATCH_SIZE = int(os.environ.get('CAPTION_MAX_BATCH_SIZE', 16))  # Upper bound of the adaptive caption batch size
+CAPTION_LATENCY_BUDGET = float(os.environ.get('CAPTION_LATENCY_BUDGET', 30))  # Target seconds per adaptive caption batch
+CAPTION_MEMORY_FRACTION = float(os.environ.get('CAPTION_MEMORY_FRACTION', 0.8))  # Adaptive batches stop growing above this fraction of GPU memory
 
 # YOLO model configuration
 YOLO_MODEL = os.environ.get('YOLO_MODEL', 'yolo11x-cls.pt')  # YOLO model file
 YOLO_CONFIDENCE = float(os.environ.get('YOLO_CONFIDENCE', 0.7))  # Confidence threshold for YOLO model
+YOLO_DEVICE = os.environ.get('YOLO_DEVICE', '')  # Device of the YOLO model e.g. cuda:1 or cpu, picked automatically when empty
+CLASSIFY_BATCH_SIZE = int(os.environ.get('CLASSIFY_BATCH_SIZE', 64))  # Batch size for classification, independent of the caption batch size
+
+# Inference backends, the non default ones are meant for CPU only nodes
+CAPTION_BACKEND = os.environ.get('CAPTION_BACKEND', 'torch')  # 'torch' or 'int8' for dynamic int8 quantization of the caption model
+YOLO_BACKEND = os.environ.get('YOLO_BACKEND', 'torch')  # 'torch', 'onnx' or 'openvino', exported models are cached next to YOLO_MODEL
+TORCH_INTRA_OP_THREADS = int(os.environ.get('TORCH_INTRA_OP_THREADS', 0))  # Threads used within a torch operator, 0 for the torch default
+TORCH_INTER_OP_THREADS = int(os.environ.get('TORCH_INTER_OP_THREADS', 0))  # Threads running independent torch operators, 0 for the torch default
+
+# Model loading configuration
+WEIGHT_CACHE_DIR = os.environ.get('WEIGHT_CACHE_DIR', '')  # Directory keeping the caption model converted to its dtype as safetensors, disabled when empty
+MODEL_SERVER_URL = os.environ.get('MODEL_SERVER_URL', '')  # URL of a model_server.py to run inference on instead of loading the models, e.g. http://127.0.0.1:8765
+MODEL_SERVER_HOST = os.environ.get('MODEL_SERVER_HOST', '127.0.0.1')  # Address model_server.py listens on
+MODEL_SERVER_PORT = int(os.environ.get('MODEL_SERVER_PORT', 8765))  # Port model_server.py listens on
 
 CLEANUP = bool_t(os.environ.get('CLEANUP', '0'))  # Enable or disable cleanup before processing
 CLEANUP_STALE_HOURS = int(os.environ.get('CLEANUP_STALE_HOURS', 24))  # Stale hours for cleanup
 
-RESUME = bool_t(os.environ.get('RESUME', '0'))  # Enable or disable resume mode
\ No newline at end of file
+RESUME = bool_t(os.environ.get('RESUME', '0'))  # Enable or disable resume mode
+
+# Incremental sync configuration
+INCREMENTAL = bool_t(os.environ.get('INCREMENTAL', '0'))  # Only process photos updated since the last sync recorded in the job database
+SYNC_INTERVAL = int(os.environ.get('SYNC_INTERVAL', 0))  # Seconds between syncs when running as a daemon, 0 to sync once and exit
+SYNC_OVERLAP_SECONDS = int(os.environ.get('SYNC_OVERLAP_SECONDS', 300))  # Each sync looks this far before the mark to absorb clock skew
+
+# Pipeline configuration
+PIPELINE = bool_t(os.environ.get('PIPELINE', '0'))  # Run download, decode, inference and update as concurrent stages
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 16))  # Max photos waiting between two stages
+PIPELINE_DOWNLOAD_WORKERS = int(os.environ.get('PIPELINE_DOWNLOAD_WORKERS', 4))  # Concurrent downloads
+PIPELINE_DECODE_WORKERS = int(os.environ.get('PIPELINE_DECODE_WORKERS', 2))  # Concurrent image decoders
+PIPELINE_UPDATE_WORKERS = int(os.environ.get('PIPELINE_UPDATE_WORKERS', 4))  # Concurrent PhotoPrism updates
+PIPELINE_BATCH_TIMEOUT = float(os.environ.get('PIPELINE_BATCH_TIMEOUT', 0.5))  # Seconds a model stage waits for a batch to fill up
+PIPELINE_STATS_INTERVAL = int(os.environ.get('PIPELINE_STATS_INTERVAL', 30))  # Seconds between stage stats logs
+
+# Work queue configuration
+QUEUE_MODE = bool_t(os.environ.get('QUEUE_MODE', '0'))  # Claim tasks seeded by seed.py from the database instead of listing PhotoPrism
+QUEUE_CLAIM_SIZE = int(os.environ.get('QUEUE_CLAIM_SIZE', 50))  # Number of tasks claimed per database round-trip
+SEED_PAGE_SIZE = int(os.environ.get('SEED_PAGE_SIZE', 500))  # Page size used by seed.py to enumerate the library
+
+# Lease configuration, photos held by a dead worker go back to pending once their lease expires
+LEASE_SECONDS = int(os.environ.get('LEASE_SECONDS', 300))  # Lease duration of an acquired photo
+LEASE_HEARTBEAT_SECONDS = int(os.environ.get('LEASE_HEARTBEAT_SECONDS', 60))  # Interval between lease renewals
+LEASE_RECLAIM_SECONDS = int(os.environ.get('LEASE_RECLAIM_SECONDS', 120))  # Interval between expired lease scans, 0 to disable
+
+# Retry configuration, a failed photo is retried after TASK_RETRY_DELAY seconds, doubled after every failure
+TASK_MAX_RETRIES = int(os.environ.get('TASK_MAX_RETRIES', 3))  # Retries of a failed photo before it is left failed, 0 to never retry
+TASK_RETRY_DELAY = int(os.environ.get('TASK_RETRY_DELAY', 300))  # Seconds before the first retry of a failed photo
+
+# HTTP client configuration for PhotoPrism calls
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))  # Max keep-alive connections to PhotoPrism, keep above the number of download and update workers
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', 3))  # Retries on connection errors, 429 and 5xx responses
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', 0.5))  # Exponential backoff factor between retries in seconds
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 10))  # Connect timeout in seconds
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))  # Read timeout in seconds
+UPDATE_CONCURRENCY = int(os.environ.get('UPDATE_CONCURRENCY', 4))  # Photo updates of a batch sent at the same time
+
+# Async I/O configuration
+ASYNC_IO = bool_t(os.environ.get('ASYNC_IO', '0'))  # Prefetch listing pages and run downloads and updates concurrently on an asyncio loop
+ASYNC_IN_FLIGHT = int(os.environ.get('ASYNC_IN_FLIGHT', 8))  # Max PhotoPrism requests in flight in async mode
+
+# Preprocessing configuration
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', 0))  # Processes decoding and preprocessing images for the models, 0 to decode on the worker thread
+
+# Metrics configuration
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # Port of the Prometheus /metrics endpoint, 0 to disable
+METRICS_HOST = os.environ.get('METRICS_HOST', '0.0.0.0')  # Address the /metrics endpoint listens on
+METRICS_LOG = os.environ.get('METRICS_LOG', '')  # File receiving a JSON record per batch, disabled when empty
+
+# Supervisor configuration, see supervisor.py
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 1))  # Number of worker processes started by the supervisor
+WORKER_DEVICES = os.environ.get('WORKER_DEVICES', '')  # Comma separated devices assigned round robin to the workers e.g. cuda:0,cuda:1 or cpu
+WORKER_THREADS = int(os.environ.get('WORKER_THREADS', 0))  # Compute threads per worker, 0 to split the CPU cores evenly
+WORKER_RESTART_DELAY = int(os.environ.get('WORKER_RESTART_DELAY', 5))  # Seconds before restarting a crashed worker, doubled on every crash in a row
+WORKER_DRAIN_SECONDS = int(os.environ.get('WORKER_DRAIN_SECONDS', 300))  # Seconds the workers get to finish their photos on SIGTERM before being killed
+CONFIG_ERROR_EXIT_CODE = 78  # Exit code of worker.py on invalid settings, which the supervisor does not restart (EX_CONFIG of sysexits.h)
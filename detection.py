@@ -1,51 +1,253 @@
 import os
 import time
+import shutil
+import hashlib
 import torch
 import platform
 import constants
+from PIL import Image
 from ultralytics import YOLO
-from transformers import AutoProcessor, Kosmos2ForConditionalGeneration, AutoModelForCausalLM
+from transformers import AutoConfig, AutoProcessor, Kosmos2ForConditionalGeneration, AutoModelForCausalLM
 
 import logging
 logger = logging.getLogger(__name__)
 
+# Thread pools of torch on CPU, 0 keeps the torch defaults
+if constants.TORCH_INTRA_OP_THREADS > 0:
+    torch.set_num_threads(constants.TORCH_INTRA_OP_THREADS)
+if constants.TORCH_INTER_OP_THREADS > 0:
+    torch.set_num_interop_threads(constants.TORCH_INTER_OP_THREADS)
+
+def quantize(model, device, backend):
+    """
+    Apply the caption backend to a loaded caption model.
+
+    'int8' replaces the Linear layers with dynamically quantized int8 ones,
+    which only runs on CPU, other devices keep the model unchanged.
+    """
+    if backend != 'int8':
+        return model
+    if device != 'cpu':
+        logger.warning(f"int8 caption backend is only supported on CPU, keeping the model as is on {device}")
+        return model
+    logger.info("Quantizing the caption model's linear layers to int8")
+    return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_pretrained(model_class, model_name, dtype, **kwargs):
+    """
+    Load a Hugging Face model in dtype, through the local weight cache when
+    WEIGHT_CACHE_DIR is set.
+
+    The first load converts the checkpoint to dtype and saves it as
+    safetensors under WEIGHT_CACHE_DIR, keyed by the model revision, later
+    loads memory-map those files instead of converting the checkpoint again.
+
+    Returns:
+        tuple: The model and its revision, 'unknown' if it cannot be told.
+    """
+    config = AutoConfig.from_pretrained(model_name, **kwargs)
+    version = getattr(config, '_commit_hash', None) or 'unknown'
+    if not constants.WEIGHT_CACHE_DIR:
+        return model_class.from_pretrained(model_name, torch_dtype=dtype, **kwargs), version
+
+    dtype_name = str(dtype).replace('torch.', '')
+    path = os.path.join(constants.WEIGHT_CACHE_DIR, f"{model_name.replace('/', '--')}--{version}--{dtype_name}")
+    if os.path.isdir(path):
+        try:
+            return model_class.from_pretrained(path, torch_dtype=dtype, **kwargs), version
+        except Exception as e:
+            logger.warning(f"Error loading cached weights from {path}, converting {model_name} again: {str(e)}")
+            shutil.rmtree(path, ignore_errors=True)
+
+    model = model_class.from_pretrained(model_name, torch_dtype=dtype, **kwargs)
+    # Written aside and renamed, so a worker killed halfway never leaves a partial
+    # cache behind, and of two workers converting at once the first one wins
+    staging = f"{path}.{os.getpid()}.tmp"
+    try:
+        model.save_pretrained(staging, safe_serialization=True)
+        os.replace(staging, path)
+        logger.info(f"Cached {model_name} weights in {path}")
+    except Exception as e:
+        logger.warning(f"Error caching {model_name} weights in {path}: {str(e)}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    return model, version
+
+def file_hash(path):
+    """Short content hash of a model file, 'unknown' if it cannot be read"""
+    try:
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.hexdigest()[:16]
+    except OSError:
+        return 'unknown'
+
+def generation_profile(model, name):
+    """
+    Prompt and generate() arguments of a profile of constants.GENERATION_PROFILES.
+
+    Returns:
+        tuple: The prompt and a dict of generate() keyword arguments.
+    """
+    profile = dict(constants.GENERATION_PROFILES[model][name])
+    return profile.pop('prompt'), profile
+
+def processor_input_size(processor, default):
+    """Longest side of the images fed to the model by a Hugging Face processor"""
+    size = getattr(getattr(processor, 'image_processor', None), 'size', None)
+    if isinstance(size, dict):
+        values = [value for value in size.values() if isinstance(value, int)]
+        if values:
+            return max(values)
+    return default
+
+def image_processor_spec(processor):
+    """Preprocessing spec (see preprocess.to_model_input) equivalent to a Hugging Face image processor"""
+    image_processor = processor.image_processor
+    spec = {
+        'rescale': image_processor.rescale_factor if image_processor.do_rescale else 1.0,
+        'mean': list(image_processor.image_mean) if image_processor.do_normalize else [0.0, 0.0, 0.0],
+        'std': list(image_processor.image_std) if image_processor.do_normalize else [1.0, 1.0, 1.0],
+    }
+    size = image_processor.size
+    if 'shortest_edge' in size:
+        spec['shortest_edge'] = size['shortest_edge']
+    else:
+        spec['size'] = (size['height'], size['width'])
+    if getattr(image_processor, 'do_center_crop', False):
+        crop_size = image_processor.crop_size
+        spec['crop'] = (crop_size['height'], crop_size['width'])
+    return spec
+
+def prompt_inputs(processor, prompt, size):
+    """
+    Text inputs of a single image for the given prompt, for batches whose
+    pixel values were computed elsewhere. The processor is run on a blank
+    image and everything except the pixel values is kept.
+    """
+    blank = Image.new("RGB", (size, size))
+    inputs = processor(text=[prompt], images=[blank], return_tensors="pt")
+    return {key: value for key, value in inputs.items() if key != "pixel_values"}
+
+def repeat_inputs(inputs, count):
+    return {key: value.repeat(count, *[1] * (value.dim() - 1)) for key, value in inputs.items()}
+
+def is_out_of_memory(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or 'out of memory' in str(error).lower()
+
+class AdaptiveBatcher:
+    """
+    Split caption batches into chunks whose size adapts to the hardware.
+
+    The chunk size starts at CAPTION_BATCH_SIZE and is resized after every
+    chunk so that one chunk takes about CAPTION_LATENCY_BUDGET seconds, at most
+    doubling each time and never exceeding CAPTION_MAX_BATCH_SIZE. Growth stops
+    once the device memory peak goes over CAPTION_MEMORY_FRACTION, and an out
+    of memory error halves the chunk and caps the size there. A chunk holding
+    a long caption takes longer per image, which shrinks the next chunks, so
+    a few long captions cannot keep large batches waiting for long.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.batch_size = max(1, constants.CAPTION_BATCH_SIZE)
+        self.max_batch_size = max(self.batch_size, constants.CAPTION_MAX_BATCH_SIZE)
+        self.latency_budget = constants.CAPTION_LATENCY_BUDGET
+        self.memory_fraction = constants.CAPTION_MEMORY_FRACTION
+        self.images = 0
+        self.seconds = 0.0
+
+    @property
+    def images_per_second(self):
+        return self.images / self.seconds if self.seconds else 0.0
+
+    def _memory_exceeded(self):
+        if self.device != 'cuda':
+            return False
+        total = torch.cuda.get_device_properties(0).total_memory
+        return torch.cuda.max_memory_allocated() > total * self.memory_fraction
+
+    def _adapt(self, size, elapsed):
+        per_image = elapsed / size
+        target = int(self.latency_budget / per_image) if per_image > 0 else self.max_batch_size
+        if target > self.batch_size and (size < self.batch_size or self._memory_exceeded()):
+            # Only grow after a full chunk that stayed within the memory budget
+            return
+        self.batch_size = max(1, min(self.max_batch_size, self.batch_size * 2, target))
+
+    def run(self, generate, batch):
+        """
+        Run generate over batch chunk by chunk.
+
+        Args:
+            generate (callable): Captions a slice of batch, raises on error.
+            batch: List of images or array of pixel values.
+
+        Returns:
+            list: Output of generate for every item of batch, in order.
+        """
+        output = []
+        start = 0
+        while start < len(batch):
+            chunk = batch[start:start + self.batch_size]
+            if self.device == 'cuda':
+                torch.cuda.reset_peak_memory_stats()
+            chunk_start = time.time()
+            try:
+                output.extend(generate(chunk))
+            except Exception as e:
+                if len(chunk) == 1 or not is_out_of_memory(e):
+                    raise
+                self.batch_size = self.max_batch_size = max(1, len(chunk) // 2)
+                if self.device == 'cuda':
+                    torch.cuda.empty_cache()
+                logger.warning(f"Out of memory with {len(chunk)} images, caption batch size capped at {self.batch_size}")
+                continue
+            elapsed = time.time() - chunk_start
+            self.images += len(chunk)
+            self.seconds += elapsed
+            start += len(chunk)
+            self._adapt(len(chunk), elapsed)
+        logger.info(f"Caption throughput {self.images_per_second:.2f} images/sec, batch size {self.batch_size}")
+        return output
+
 class Kosmos2DescriptionGenerator:
 
-    def __init__(self):
-        self.prompt = "An image of"
-        self.model = Kosmos2ForConditionalGeneration.from_pretrained(constants.KOSMOS2_MODEL)
+    def __init__(self, backend=constants.CAPTION_BACKEND, profile=constants.CAPTION_PROFILE):
+        self.prompt, self.generate_kwargs = generation_profile("kosmos2", profile)
+        self.model_name = constants.KOSMOS2_MODEL
         
         self.device = 'cpu'
         if torch.cuda.is_available():
             self.device = 'cuda'
         elif torch.backends.mps.is_available():
             self.device = 'mps'
-        self.model = self.model.to(self.device)
+        self.model, self.model_version = load_pretrained(Kosmos2ForConditionalGeneration, constants.KOSMOS2_MODEL, torch.float32)
+        self.model = quantize(self.model.to(self.device), self.device, backend)
         
         self.processor = AutoProcessor.from_pretrained(constants.KOSMOS2_MODEL)
+        self.input_size = processor_input_size(self.processor, 224)
+        self.prompt_inputs = None
+        self.batcher = AdaptiveBatcher(self.device) if constants.ADAPTIVE_BATCH else None
+        
+    def preprocess_spec(self):
+        return image_processor_spec(self.processor)
         
-    def generate(self, images):        
+    def generate(self, images=None, pixel_values=None):
+        """
+        Caption a batch of PIL images, or of pixel values already preprocessed
+        according to preprocess_spec.
+        """
         try:
             start_time = time.time()
-            inputs = self.processor(text=[self.prompt]*len(images), images=images, return_tensors="pt")
-            output = []
-            
-            generated_ids = self.model.generate(
-                pixel_values=inputs["pixel_values"].to(self.device),
-                input_ids=inputs["input_ids"].to(self.device),
-                attention_mask=inputs["attention_mask"].to(self.device),
-                image_embeds=None,
-                image_embeds_position_mask=inputs["image_embeds_position_mask"].to(self.device),
-                use_cache=True,
-                max_new_tokens=128,
-            )
-            
-            generated_ids = generated_ids.cpu()
-            generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
-            
-            for text in generated_texts:
-                processed_text, _ = self.processor.post_process_generation(text)
-                output.append(processed_text)
+            preprocessed = pixel_values is not None
+            batch = pixel_values if preprocessed else images
+            if self.batcher:
+                output = self.batcher.run(lambda chunk: self._generate(chunk, preprocessed), batch)
+            else:
+                output = self._generate(batch, preprocessed)
                 
             end_time = time.time()
             logger.info(f"Caption generation took {end_time - start_time:.2f} seconds")
@@ -55,11 +257,39 @@ class Kosmos2DescriptionGenerator:
             logger.error(f"Error generating caption: {str(e)}")
             return None
         
+    def _generate(self, batch, preprocessed):
+        if preprocessed:
+            if self.prompt_inputs is None:
+                self.prompt_inputs = prompt_inputs(self.processor, self.prompt, self.input_size)
+            inputs = repeat_inputs(self.prompt_inputs, len(batch))
+            inputs["pixel_values"] = torch.from_numpy(batch)
+        else:
+            inputs = self.processor(text=[self.prompt]*len(batch), images=batch, return_tensors="pt")
+        output = []
+        
+        generated_ids = self.model.generate(
+            pixel_values=inputs["pixel_values"].to(self.device),
+            input_ids=inputs["input_ids"].to(self.device),
+            attention_mask=inputs["attention_mask"].to(self.device),
+            image_embeds=None,
+            image_embeds_position_mask=inputs["image_embeds_position_mask"].to(self.device),
+            use_cache=True,
+            **self.generate_kwargs,
+        )
+        
+        generated_ids = generated_ids.cpu()
+        generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+        
+        for text in generated_texts:
+            processed_text, _ = self.processor.post_process_generation(text)
+            output.append(processed_text)
+        return output
+        
 class Florence2DescriptionGenerator:
 
-    def __init__(self):
-        self.prompt = "<MORE_DETAILED_CAPTION>"
-        self.model = AutoModelForCausalLM.from_pretrained(constants.FLORENCE2_MODEL, trust_remote_code=True)
+    def __init__(self, backend=constants.CAPTION_BACKEND, profile=constants.CAPTION_PROFILE):
+        self.prompt, self.generate_kwargs = generation_profile("florence2", profile)
+        self.model_name = constants.FLORENCE2_MODEL
         
         self.device = 'cpu'
         self.torch_dtype = torch.float32
@@ -69,34 +299,31 @@ class Florence2DescriptionGenerator:
         elif torch.backends.mps.is_available():
             self.device = 'mps'
             self.torch_dtype = torch.float16
-        self.model = self.model.to(dtype=self.torch_dtype, device=self.device)
+        self.model, self.model_version = load_pretrained(AutoModelForCausalLM, constants.FLORENCE2_MODEL, self.torch_dtype,
+                                                         trust_remote_code=True)
+        self.model = quantize(self.model.to(device=self.device), self.device, backend)
         
         self.processor = AutoProcessor.from_pretrained(constants.FLORENCE2_MODEL, trust_remote_code=True)
+        self.input_size = processor_input_size(self.processor, 768)
+        self.prompt_inputs = None
+        self.batcher = AdaptiveBatcher(self.device) if constants.ADAPTIVE_BATCH else None
         
-    def generate(self, images):        
+    def preprocess_spec(self):
+        return image_processor_spec(self.processor)
+        
+    def generate(self, images=None, pixel_values=None):
+        """
+        Caption a batch of PIL images, or of pixel values already preprocessed
+        according to preprocess_spec.
+        """
         try:
             start_time = time.time()
-            
-            inputs = self.processor(
-                text=[self.prompt]*len(images), 
-                images=images, 
-                return_tensors="pt"
-                ).to(self.device, self.torch_dtype)
-            output = []
-            
-            generated_ids = self.model.generate(
-                pixel_values=inputs["pixel_values"],
-                input_ids=inputs["input_ids"],
-                max_new_tokens=1024,
-                num_beams=3,
-            )
-            
-            generated_ids = generated_ids.cpu()
-            generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
-            
-            for text in generated_texts:
-                processed_text = text.replace('<s>', '').replace('</s>', '')
-                output.append(processed_text)
+            preprocessed = pixel_values is not None
+            batch = pixel_values if preprocessed else images
+            if self.batcher:
+                output = self.batcher.run(lambda chunk: self._generate(chunk, preprocessed), batch)
+            else:
+                output = self._generate(batch, preprocessed)
             
             end_time = time.time()
             logger.info(f"Caption generation took {end_time - start_time:.2f} seconds")
@@ -105,23 +332,104 @@ class Florence2DescriptionGenerator:
         except Exception as e:
             logger.error(f"Error generating caption: {str(e)}")
             return None
+        
+    def _generate(self, batch, preprocessed):
+        if preprocessed:
+            if self.prompt_inputs is None:
+                self.prompt_inputs = prompt_inputs(self.processor, self.prompt, self.input_size)
+            inputs = repeat_inputs(self.prompt_inputs, len(batch))
+            inputs = {
+                "input_ids": inputs["input_ids"].to(self.device),
+                "pixel_values": torch.from_numpy(batch).to(self.device, self.torch_dtype),
+            }
+        else:
+            inputs = self.processor(
+                text=[self.prompt]*len(batch), 
+                images=batch, 
+                return_tensors="pt"
+                ).to(self.device, self.torch_dtype)
+        output = []
+        
+        generated_ids = self.model.generate(
+            pixel_values=inputs["pixel_values"],
+            input_ids=inputs["input_ids"],
+            **self.generate_kwargs,
+        )
+        
+        generated_ids = generated_ids.cpu()
+        generated_texts = self.processor.batch_decode(generated_ids, skip_special_tokens=True)
+        
+        for text in generated_texts:
+            processed_text = text.replace('<s>', '').replace('</s>', '')
+            output.append(processed_text)
+        return output
 
 class Classifier:
     
-    def __init__(self):
+    def __init__(self, backend=constants.YOLO_BACKEND):
         self.model = YOLO(constants.YOLO_MODEL)
+        self.model_name = constants.YOLO_MODEL
+        self.model_version = file_hash(getattr(self.model, 'ckpt_path', None) or constants.YOLO_MODEL)
+        args = getattr(self.model.model, 'args', None)
+        self.input_size = args.get('imgsz', 224) if isinstance(args, dict) else 224
+        
+        # Pin the device and precision instead of letting ultralytics pick them on every call
+        self.device = constants.YOLO_DEVICE
+        if not self.device:
+            self.device = 'cpu'
+            if torch.cuda.is_available():
+                self.device = 'cuda'
+            elif torch.backends.mps.is_available():
+                self.device = 'mps'
+        self.half = self.device.startswith('cuda')
+        self.batch_size = max(1, constants.CLASSIFY_BATCH_SIZE)
+        
+        if backend in ('onnx', 'openvino'):
+            self.model = YOLO(self.export(backend), task='classify')
+            self.half = False
+        
+    def export(self, backend):
+        """
+        Export the YOLO model for the given backend once, next to the model file.
+
+        Returns:
+            str: Path of the exported model.
+        """
+        base = os.path.splitext(constants.YOLO_MODEL)[0]
+        path = f"{base}.onnx" if backend == 'onnx' else f"{base}_openvino_model"
+        if not os.path.exists(path):
+            logger.info(f"Exporting {constants.YOLO_MODEL} to {backend}")
+            path = self.model.export(format=backend, imgsz=self.input_size, dynamic=True)
+        return path
+        
+    def preprocess_spec(self):
+        # Same as the ultralytics classification transforms: resize, center crop, scale to [0, 1]
+        return {
+            'shortest_edge': self.input_size,
+            'crop': (self.input_size, self.input_size),
+            'rescale': 1 / 255,
+            'mean': [0.0, 0.0, 0.0],
+            'std': [1.0, 1.0, 1.0],
+        }
         
-    def classify(self, images):
+    def classify(self, images=None, pixel_values=None):
+        """
+        Classify a batch of PIL images, or of pixel values already preprocessed
+        according to preprocess_spec, in chunks of CLASSIFY_BATCH_SIZE.
+        """
         output = []
         try:
             start_time = time.time()
-            results = self.model.predict(images, verbose=False)
-            for result in results:
-                temp = []
-                for idx, label in enumerate(result.probs.top5):
-                    if result.probs.top5conf[idx] > constants.YOLO_CONFIDENCE:
-                        temp.append(result.names[label])
-                output.append(temp)
+            source = torch.from_numpy(pixel_values) if pixel_values is not None else images
+            for start in range(0, len(source), self.batch_size):
+                results = self.model.predict(source[start:start + self.batch_size], device=self.device,
+                                             half=self.half, verbose=False)
+                for result in results:
+                    temp = []
+                    for idx, label in enumerate(result.probs.top5):
+                        if result.probs.top5conf[idx] > constants.YOLO_CONFIDENCE:
+                            temp.append(result.names[label])
+                    output.append(temp)
                 
             end_time = time.time()
             logger.info(f"Label generation took {end_time - start_time:.2f} seconds")
@@ -129,4 +437,3 @@ class Classifier:
         except Exception as e:
             logger.error(f"Error classifying: {str(e)}")
             return []
-        
\ No newline at end of file
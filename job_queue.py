@@ -1,12 +1,17 @@
-from sqlalchemy import create_engine, Column, String, DateTime, Enum
+from sqlalchemy import create_engine, event, inspect, text, Column, String, DateTime, Boolean, Integer, Enum, Index, and_, or_, case, func, insert, select, update
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime, timedelta
 import enum
+import atexit
 import logging
-from typing import Tuple, Union, Dict
-from sqlalchemy.dialects.mysql import ENUM
+import threading
+import time
+from typing import Tuple, Union, Dict, List, Optional
+from sqlalchemy.dialects.mysql import ENUM, insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 import constants
+import metrics
 
 Base = declarative_base()
 
@@ -23,7 +28,19 @@ class PhotoTask(Base):
     worker_id = Column(String(100), nullable=True)
     started_at = Column(DateTime, nullable=True)
     completed_at = Column(DateTime, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
     error_message = Column(String(500), nullable=True)
+    # Failed tasks are retried at next_retry_at, with an exponential backoff, until
+    # retry_count reaches TASK_MAX_RETRIES and next_retry_at is left empty
+    retry_count = Column(Integer, nullable=True, default=0)
+    next_retry_at = Column(DateTime, nullable=True)
+    
+    # Photo details stored by seed.py so workers can claim tasks without listing PhotoPrism
+    photo_hash = Column(String(64), nullable=True)
+    file_name = Column(String(1024), nullable=True)
+    has_caption = Column(Boolean, nullable=True)
+    # Generation profile the caption was written with, see constants.GENERATION_PROFILES
+    caption_profile = Column(String(32), nullable=True)
     
     if constants.DP:
         status = Column(
@@ -35,6 +52,51 @@ class PhotoTask(Base):
     else:
         status = Column(String(20), nullable=False, default='pending')
 
+    __table_args__ = (
+        # Keeps the stale task scan and the scan of tasks without a lease cheap on large tables
+        Index('ix_photo_tasks_status_started_at', 'status', 'started_at'),
+        # Keeps the expired lease scan of the lease keeper cheap
+        Index('ix_photo_tasks_status_lease_expires_at', 'status', 'lease_expires_at'),
+        # Keeps finding the failed tasks due for a retry cheap
+        Index('ix_photo_tasks_status_next_retry_at', 'status', 'next_retry_at'),
+    )
+
+
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+    
+    # High-water mark of incremental syncs, photos updated before synced_at have been seen
+    name = Column(String(64), primary_key=True)
+    synced_at = Column(DateTime, nullable=False)
+
+
+# Kept apart from Base, the counters only exist in SQLite job databases
+CounterBase = declarative_base()
+
+class TaskCount(CounterBase):
+    __tablename__ = 'task_counts'
+    
+    # Number of tasks per status, kept up to date by the triggers below
+    status = Column(String(20), primary_key=True)
+    count = Column(Integer, nullable=False)
+
+
+COUNT_TRIGGERS = (
+    """CREATE TRIGGER photo_tasks_count_insert AFTER INSERT ON photo_tasks BEGIN
+        INSERT INTO task_counts (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END""",
+    """CREATE TRIGGER photo_tasks_count_update AFTER UPDATE OF status ON photo_tasks
+    WHEN OLD.status IS NOT NEW.status BEGIN
+        UPDATE task_counts SET count = count - 1 WHERE status = OLD.status;
+        INSERT INTO task_counts (status, count) VALUES (NEW.status, 1)
+        ON CONFLICT (status) DO UPDATE SET count = count + 1;
+    END""",
+    """CREATE TRIGGER photo_tasks_count_delete AFTER DELETE ON photo_tasks BEGIN
+        UPDATE task_counts SET count = count - 1 WHERE status = OLD.status;
+    END""",
+)
+
 
 class PhotoProcessor:
     def __init__(self, worker_id: str = 'worker1'):
@@ -54,6 +116,19 @@ class PhotoProcessor:
         self.worker_id = worker_id
         self.logger = logging.getLogger(__name__)
         
+        # Photos currently held by this worker, their leases are renewed by the lease keeper
+        self.in_flight = set()
+        self.in_flight_lock = threading.Lock()
+        self.lease_stop = threading.Event()
+        self.lease_thread = None
+        
+        # Completions waiting for the next batched commit, by (error message, caption profile)
+        self.deferred = {}
+        self.deferred_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        if constants.JOB_COMMIT_INTERVAL > 0:
+            atexit.register(self.flush)
+        
         if constants.DP:
             if not all([constants.DB_HOST, 
                         constants.DB_PORT, 
@@ -69,11 +144,125 @@ class PhotoProcessor:
         self.TaskModel = PhotoTask
 
         self.engine = create_engine(db_url, 
-                                  pool_recycle=3600 if self.db_type=='mariadb' else -1)
+                                  pool_recycle=3600 if self.db_type=='mariadb' else -1,
+                                  connect_args={} if self.db_type=='mariadb' else {'timeout': constants.SQLITE_BUSY_TIMEOUT})
+        # Read-only queries, on SQLite they get connections of their own that never take the write lock
+        self.read_engine = self.engine
+        if self.db_type == 'sqlite':
+            self.read_engine = create_engine(db_url, connect_args={'timeout': constants.SQLITE_BUSY_TIMEOUT})
+            # A transaction reading before it writes would otherwise race other
+            # processes, e.g. two workers acquiring the same photo
+            self._tune_sqlite(self.engine, "BEGIN IMMEDIATE")
+            self._tune_sqlite(self.read_engine, "BEGIN")
         
         Base.metadata.create_all(self.engine)
+        self._migrate()
+        if self.db_type == 'sqlite':
+            self._create_counters()
         self.Session = sessionmaker(bind=self.engine)
+        self.ReadSession = sessionmaker(bind=self.read_engine)
+
+    def _tune_sqlite(self, engine, begin_statement: str) -> None:
+        """
+        Set up every SQLite connection of engine for several local workers
+        sharing the file: WAL so reads never wait on a write, relaxed syncs,
+        and transactions begun with begin_statement. Write transactions take
+        the write lock as they begin with BEGIN IMMEDIATE, reads use a
+        deferred BEGIN.
+        """
+        @event.listens_for(engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            # Transactions are begun below rather than by the driver
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"PRAGMA journal_mode={constants.SQLITE_JOURNAL_MODE}")
+            cursor.execute(f"PRAGMA synchronous={constants.SQLITE_SYNCHRONOUS}")
+            cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def begin(conn):
+            conn.exec_driver_sql(begin_statement)
+
+    def _create_counters(self) -> None:
+        """
+        Keep the number of tasks per status in task_counts, maintained by
+        triggers in the same transaction as the tasks, so resume and progress
+        never count photo_tasks. Existing tasks are counted once, when the
+        triggers are created.
+        """
+        CounterBase.metadata.create_all(self.engine)
+        try:
+            with self.engine.begin() as conn:
+                if conn.scalar(text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'photo_tasks_count_insert'")):
+                    return
+                conn.execute(text("DELETE FROM task_counts"))
+                conn.execute(text("INSERT INTO task_counts (status, count) SELECT status, COUNT(*) FROM photo_tasks GROUP BY status"))
+                for trigger in COUNT_TRIGGERS:
+                    conn.execute(text(trigger))
+            self.logger.info("Created the task counters")
+        except Exception as e:
+            self.logger.warning(f"Error creating the task counters: {str(e)}")
+
+    def _migrate(self) -> None:
+        """Add columns and indexes introduced after the table was created, create_all only creates missing tables"""
+        table = self.TaskModel.__table__
+        existing = {column['name'] for column in inspect(self.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=self.engine.dialect)
+            try:
+                with self.engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                self.logger.info(f"Added column {column.name} to {table.name}")
+            except Exception as e:
+                # Another worker may have migrated the table at the same time
+                self.logger.warning(f"Error adding column {column.name} to {table.name}: {str(e)}")
+        for index in table.indexes:
+            try:
+                index.create(bind=self.engine, checkfirst=True)
+            except Exception as e:
+                self.logger.warning(f"Error creating index {index.name} on {table.name}: {str(e)}")
 
+    def _lease_expiry(self) -> datetime:
+        return datetime.utcnow() + timedelta(seconds=constants.LEASE_SECONDS)
+
+    def _hold(self, photo_uids) -> None:
+        with self.in_flight_lock:
+            self.in_flight.update(photo_uids)
+
+    def _drop(self, photo_uids) -> None:
+        with self.in_flight_lock:
+            self.in_flight.difference_update(photo_uids)
+
+    def _available(self, now):
+        # Tasks that can be acquired: pending ones and failed ones due for a retry,
+        # failed tasks from before retries were tracked are retried right away
+        task = self.TaskModel
+        return or_(
+            task.status == 'pending',
+            and_(task.status == 'failed', or_(task.next_retry_at <= now, task.retry_count.is_(None))),
+        )
+
+    def _failure(self, error_message, now):
+        # Ordered values marking tasks failed, scheduling their next retry from the number of
+        # earlier failures. MariaDB assigns in order, next_retry_at must be computed before
+        # retry_count is incremented, pass them to ordered_values
+        retries = func.coalesce(self.TaskModel.retry_count, 0)
+        backoff = [
+            (retries == count, now + timedelta(seconds=constants.TASK_RETRY_DELAY * 2 ** count))
+            for count in range(max(0, constants.TASK_MAX_RETRIES))
+        ]
+        return [
+            ('next_retry_at', case(*backoff, else_=None) if backoff else None),
+            ('retry_count', retries + 1),
+            ('status', 'failed'),
+            ('error_message', error_message[:500]),
+            ('completed_at', now),
+            ('lease_expires_at', None),
+        ]
+
+    @metrics.db_operation
     def try_acquire_photo(self, photo_uid: str) -> bool:
         session = self.Session()
         try:
@@ -101,10 +290,17 @@ class PhotoProcessor:
                 self.logger.info(f"Photo {photo_uid} is being processed by worker {task.worker_id}, will skip")
                 return False
             
+            if task.status == 'failed' and task.retry_count is not None and not (
+                    task.next_retry_at and task.next_retry_at <= datetime.utcnow()):
+                self.logger.info(f"Photo {photo_uid} failed and is not due for a retry, will skip")
+                return False
+            
             task.status = 'processing'
             task.worker_id = self.worker_id
             task.started_at = datetime.utcnow()
+            task.lease_expires_at = self._lease_expiry()
             session.commit()
+            self._hold([photo_uid])
             return True
             
         except Exception as e:
@@ -114,43 +310,515 @@ class PhotoProcessor:
         finally:
             session.close()
             
-    def get_finish_job_count(self) -> int:
+    @metrics.db_operation
+    def try_acquire_photos(self, photo_uids: List[str], photos: Optional[List[Dict]] = None) -> List[str]:
+        """
+        Acquire as many of the given photos as possible in a single transaction.
+
+        Missing tasks are inserted as pending, then every pending task and every
+        failed task due for a retry is switched to processing for this worker. On MariaDB the rows are locked
+        with SKIP LOCKED so rows held by other workers are skipped instead of
+        waited on, on SQLite the database lock makes a single UPDATE ... RETURNING
+        atomic.
+
+        Args:
+            photo_uids: UIDs of the photos to acquire
+            photos: Listing rows of the photos, their Hash and FileName are stored on the
+                acquired tasks so claim_tasks can retry them if they fail
+
+        Returns:
+            List[str]: The photo UIDs acquired by this worker, in input order.
+        """
+        if not photo_uids:
+            return []
+            
         session = self.Session()
         try:
-            count = session.query(self.TaskModel).count()
-            return count
+            now = datetime.utcnow()
+            lease = self._lease_expiry()
+            rows = [{'photo_uid': photo_uid, 'status': 'pending'} for photo_uid in photo_uids]
+            
+            if self.db_type == 'mariadb':
+                session.execute(insert(self.TaskModel).prefix_with('IGNORE'), rows)
+                acquired = set(session.scalars(
+                    select(self.TaskModel.photo_uid)
+                    .where(self.TaskModel.photo_uid.in_(photo_uids), self._available(now))
+                    .with_for_update(skip_locked=True)
+                ).all())
+                if acquired:
+                    session.execute(
+                        update(self.TaskModel)
+                        .where(self.TaskModel.photo_uid.in_(list(acquired)))
+                        .values(status='processing', worker_id=self.worker_id, started_at=now, lease_expires_at=lease)
+                    )
+            else:
+                session.execute(sqlite_insert(self.TaskModel).on_conflict_do_nothing(), rows)
+                acquired = set(session.scalars(
+                    update(self.TaskModel)
+                    .where(self.TaskModel.photo_uid.in_(photo_uids), self._available(now))
+                    .values(status='processing', worker_id=self.worker_id, started_at=now, lease_expires_at=lease)
+                    .returning(self.TaskModel.photo_uid)
+                ).all())
+                
+            files = [{'photo_uid': photo['UID'], 'photo_hash': photo['Hash'], 'file_name': photo['FileName']}
+                     for photo in photos or [] if photo['UID'] in acquired]
+            if files:
+                session.execute(update(self.TaskModel), files)
+            session.commit()
+            self._hold(acquired)
+            
+            skipped = len(photo_uids) - len(acquired)
+            if skipped:
+                self.logger.info(f"Skipped {skipped} photos already completed, being processed by another worker or waiting for a retry")
+            return [photo_uid for photo_uid in photo_uids if photo_uid in acquired]
+            
         except Exception as e:
-            self.logger.error(f"Error getting job count: {str(e)}")
-            return None
+            session.rollback()
+            self.logger.error(f"Error acquiring photos: {str(e)}")
+            return []
         finally:
             session.close()
+            
+    @metrics.db_operation
+    def seed_tasks(self, photos: List[Dict]) -> int:
+        """
+        Insert or refresh tasks for a page of photos from the PhotoPrism listing.
 
-    def mark_complete(self, photo_uid: str, error_message: str = None) -> bool:
+        New photos are inserted as pending, existing tasks keep their status and
+        only get their Hash, FileName and caption state refreshed, except
+        completed tasks whose file was replaced which go back to pending.
+
+        Returns:
+            int: Number of photos written, or -1 on error.
+        """
+        if not photos:
+            return 0
+            
         session = self.Session()
         try:
-            query = session.query(self.TaskModel).filter_by(photo_uid=photo_uid)
+            rows = [{
+                'photo_uid': photo['UID'],
+                'status': 'pending',
+                'photo_hash': photo['Hash'],
+                'file_name': photo['FileName'],
+                'has_caption': bool(photo['Caption']),
+            } for photo in photos]
             
             if self.db_type == 'mariadb':
-                query = query.with_for_update()
+                stmt = mysql_insert(self.TaskModel)
+                # MariaDB assigns in order, has_caption and status must be computed
+                # before status and photo_hash are overwritten
+                stmt = stmt.on_duplicate_key_update([
+                    ('has_caption', self._caption_state(stmt.inserted.photo_hash, stmt.inserted.has_caption)),
+                    ('status', self._requeue_replaced(stmt.inserted.photo_hash)),
+                    ('photo_hash', stmt.inserted.photo_hash),
+                    ('file_name', stmt.inserted.file_name),
+                ])
+            else:
+                stmt = sqlite_insert(self.TaskModel)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['photo_uid'],
+                    set_={
+                        'status': self._requeue_replaced(stmt.excluded.photo_hash),
+                        'photo_hash': stmt.excluded.photo_hash,
+                        'file_name': stmt.excluded.file_name,
+                        'has_caption': self._caption_state(stmt.excluded.photo_hash, stmt.excluded.has_caption),
+                    },
+                )
+            session.execute(stmt, rows)
+            session.commit()
+            return len(rows)
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error seeding photo tasks: {str(e)}")
+            return -1
+        finally:
+            session.close()
+            
+    def _replaced(self, new_hash):
+        # Completed tasks whose photo file was replaced since, i.e. whose Hash changed
+        task = self.TaskModel
+        return and_(task.status == 'completed', task.photo_hash.isnot(None), task.photo_hash != new_hash)
+
+    def _requeue_replaced(self, new_hash):
+        # Status of a seeded task: completed tasks whose Hash changed are processed again
+        return case((self._replaced(new_hash), 'pending'), else_=self.TaskModel.status)
+
+    def _caption_state(self, new_hash, has_caption):
+        # A requeued task is claimed like an uncaptioned photo, the caption in the listing is the one of the old file
+        return case((self._replaced(new_hash), False), else_=has_caption)
+        
+    @metrics.db_operation
+    def replaced_tasks(self, photos: List[Dict]) -> List[str]:
+        """
+        UIDs of the completed tasks whose photo file changed since it was
+        processed, i.e. whose recorded Hash differs from the listing.
+        """
+        if not photos:
+            return []
+            
+        session = self.ReadSession()
+        try:
+            hashes = {photo['UID']: photo['Hash'] for photo in photos}
+            rows = session.execute(
+                select(self.TaskModel.photo_uid, self.TaskModel.photo_hash)
+                .where(self.TaskModel.photo_uid.in_(list(hashes)),
+                       self.TaskModel.status == 'completed',
+                       self.TaskModel.photo_hash.isnot(None))
+            ).all()
+            return [row.photo_uid for row in rows if row.photo_hash != hashes[row.photo_uid]]
+        except Exception as e:
+            self.logger.error(f"Error looking up replaced photos: {str(e)}")
+            return []
+        finally:
+            session.close()
+            
+    @metrics.db_operation
+    def claim_tasks(self, limit: int, include_captioned: bool = False, retries: bool = False) -> List[Dict]:
+        """
+        Claim up to limit pending seeded tasks, or failed ones due for a retry, for this worker.
+
+        With retries only failed tasks due for a retry are claimed, which lets
+        listing and sync workers retry the photos they do not list again.
+
+        The claim is a lease: the task is held by this worker until
+        lease_expires_at, which the lease keeper keeps pushing back while the
+        photo is in flight, and goes back to pending once it expires.
+
+        Args:
+            limit: Maximum number of tasks to claim
+            include_captioned: Also claim photos that already had a caption when seeded
+            retries: Only claim failed tasks due for a retry
+
+        Returns:
+            List[Dict]: Claimed photos with the UID, Hash and FileName keys of the PhotoPrism listing.
+        """
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            lease = self._lease_expiry()
+            columns = (self.TaskModel.photo_uid, self.TaskModel.photo_hash, self.TaskModel.file_name)
+            conditions = [self._available(now), self.TaskModel.photo_hash.isnot(None)]
+            if retries:
+                conditions = [and_(self._available(now), self.TaskModel.status == 'failed'),
+                              self.TaskModel.photo_hash.isnot(None)]
+            elif not include_captioned:
+                conditions.append(self.TaskModel.has_caption.isnot(True))
+            
+            if self.db_type == 'mariadb':
+                rows = session.execute(
+                    select(*columns)
+                    .where(*conditions)
+                    .limit(limit)
+                    .with_for_update(skip_locked=True)
+                ).all()
+                if rows:
+                    session.execute(
+                        update(self.TaskModel)
+                        .where(self.TaskModel.photo_uid.in_([row.photo_uid for row in rows]))
+                        .values(status='processing', worker_id=self.worker_id, started_at=now, lease_expires_at=lease)
+                    )
+            else:
+                pending = select(self.TaskModel.photo_uid).where(*conditions).limit(limit)
+                rows = session.execute(
+                    update(self.TaskModel)
+                    .where(self.TaskModel.photo_uid.in_(pending))
+                    .values(status='processing', worker_id=self.worker_id, started_at=now, lease_expires_at=lease)
+                    .returning(*columns)
+                    .execution_options(synchronize_session=False)
+                ).all()
                 
-            task = query.first()
+            session.commit()
+            self._hold([row.photo_uid for row in rows])
+            return [{'UID': row.photo_uid, 'Hash': row.photo_hash, 'FileName': row.file_name} for row in rows]
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error claiming photo tasks: {str(e)}")
+            return []
+        finally:
+            session.close()
+            
+    @metrics.db_operation
+    def release_tasks(self, photo_uids: List[str]) -> bool:
+        """Return tasks held by this worker to pending without marking them failed"""
+        if not photo_uids:
+            return True
+            
+        session = self.Session()
+        try:
+            session.execute(
+                update(self.TaskModel)
+                .where(self.TaskModel.photo_uid.in_(photo_uids),
+                       self.TaskModel.worker_id == self.worker_id,
+                       self.TaskModel.status == 'processing')
+                .values(status='pending', worker_id=None, started_at=None, lease_expires_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            self._drop(photo_uids)
+            return True
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error releasing photo tasks: {str(e)}")
+            return False
+        finally:
+            session.close()
+            
+    @metrics.db_operation
+    def requeue_profile(self, caption_profile: str) -> int:
+        """
+        Return completed tasks captioned with caption_profile to pending, so a
+        later run re-captions them with another profile.
+
+        Returns:
+            int: Number of requeued tasks, -1 on error.
+        """
+        session = self.Session()
+        try:
+            result = session.execute(
+                update(self.TaskModel)
+                .where(self.TaskModel.status == 'completed',
+                       self.TaskModel.caption_profile == caption_profile)
+                .values(status='pending', worker_id=None, started_at=None, completed_at=None, lease_expires_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            return result.rowcount
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error requeueing photo tasks of profile {caption_profile}: {str(e)}")
+            return -1
+        finally:
+            session.close()
+            
+    @metrics.db_operation
+    def get_sync_mark(self, name: str = 'photos') -> Union[datetime, None, bool]:
+        """
+        High-water mark of the last complete incremental sync.
+
+        Returns:
+            The mark, None if there was no complete sync yet, False on error.
+        """
+        session = self.ReadSession()
+        try:
+            return session.scalar(select(SyncState.synced_at).where(SyncState.name == name))
+        except Exception as e:
+            self.logger.error(f"Error getting sync mark: {str(e)}")
+            return False
+        finally:
+            session.close()
             
-            if task:
-                task.completed_at = datetime.utcnow()
+    @metrics.db_operation
+    def set_sync_mark(self, synced_at: datetime, name: str = 'photos') -> bool:
+        session = self.Session()
+        try:
+            state = session.get(SyncState, name)
+            if state is None:
+                session.add(SyncState(name=name, synced_at=synced_at))
+            else:
+                state.synced_at = synced_at
+            session.commit()
+            return True
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error setting sync mark: {str(e)}")
+            return False
+        finally:
+            session.close()
+            
+    def get_finish_job_count(self) -> int:
+        """Number of tasks in the job database, None on error"""
+        counts = self.get_status_counts()
+        if counts is None:
+            return None
+        return sum(counts.values())
+
+    @metrics.db_operation
+    def get_status_counts(self) -> Optional[Dict[str, int]]:
+        """
+        Number of tasks per status, read from the task counters on SQLite and
+        counted over the status index on MariaDB.
+
+        Returns:
+            Dict[str, int]: Count per status, None on error.
+        """
+        session = self.ReadSession()
+        try:
+            if self.db_type == 'mariadb':
+                rows = session.execute(
+                    select(self.TaskModel.status, func.count()).group_by(self.TaskModel.status)
+                ).all()
+            else:
+                rows = session.execute(select(TaskCount.status, TaskCount.count)).all()
+            return {status: count for status, count in rows if count}
+        except Exception as e:
+            self.logger.error(f"Error getting task counts: {str(e)}")
+            return None
+        finally:
+            session.close()
+
+    def mark_complete(self, photo_uid: str, error_message: str = None) -> bool:
+        return self.mark_complete_many([photo_uid], error_message)
+
+    @metrics.db_operation
+    def mark_complete_many(self, photo_uids: List[str], error_message: str = None, caption_profile: str = None) -> bool:
+        """
+        Mark several photo tasks completed (or failed with error_message) in one
+        statement, recording the generation profile of their captions. Failed
+        tasks are scheduled for a retry, see PhotoTask.retry_count.
+
+        With JOB_COMMIT_INTERVAL set, the tasks are only committed with the
+        next flush, at most that many seconds later. Their leases are renewed
+        until then.
+        """
+        if not photo_uids:
+            return True
+        if constants.JOB_COMMIT_INTERVAL > 0:
+            with self.deferred_lock:
+                self.deferred.setdefault((error_message, caption_profile), []).extend(photo_uids)
+                due = time.monotonic() - self.last_flush >= constants.JOB_COMMIT_INTERVAL
+            return self.flush() if due else True
+        return self._write_completions({(error_message, caption_profile): list(photo_uids)})
+
+    def flush(self) -> bool:
+        """Commit the completions deferred by JOB_COMMIT_INTERVAL in a single transaction"""
+        with self.deferred_lock:
+            deferred, self.deferred = self.deferred, {}
+            self.last_flush = time.monotonic()
+        if not deferred:
+            return True
+        if self._write_completions(deferred):
+            return True
+        # Kept for the next flush, the leases of the tasks are still renewed meanwhile
+        with self.deferred_lock:
+            for key, photo_uids in deferred.items():
+                self.deferred.setdefault(key, []).extend(photo_uids)
+        return False
+
+    def _write_completions(self, completions: Dict[Tuple[Optional[str], Optional[str]], List[str]]) -> bool:
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            for (error_message, caption_profile), photo_uids in completions.items():
                 if error_message:
-                    task.status = 'failed'
-                    task.error_message = error_message
+                    values = self._failure(error_message, now)
                 else:
-                    task.status = 'completed'
-                session.commit()
-                return True
+                    values = [('status', 'completed'), ('completed_at', now), ('lease_expires_at', None),
+                              ('next_retry_at', None), ('caption_profile', caption_profile)]
+                session.execute(
+                    update(self.TaskModel)
+                    .where(self.TaskModel.photo_uid.in_(photo_uids))
+                    .ordered_values(*values)
+                    .execution_options(synchronize_session=False)
+                )
+            session.commit()
+            for photo_uids in completions.values():
+                self._drop(photo_uids)
+            return True
         except Exception as e:
             session.rollback()
-            self.logger.error(f"Error marking photo task complete: {str(e)}")
+            self.logger.error(f"Error marking photo tasks complete: {str(e)}")
             return False
         finally:
             session.close()
 
+    @metrics.db_operation
+    def renew_leases(self) -> int:
+        """Push back the lease of every photo this worker still has in flight"""
+        with self.in_flight_lock:
+            photo_uids = list(self.in_flight)
+        if not photo_uids:
+            return 0
+            
+        session = self.Session()
+        try:
+            result = session.execute(
+                update(self.TaskModel)
+                .where(self.TaskModel.photo_uid.in_(photo_uids),
+                       self.TaskModel.worker_id == self.worker_id,
+                       self.TaskModel.status == 'processing')
+                .values(lease_expires_at=self._lease_expiry())
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            if result.rowcount < len(photo_uids):
+                self.logger.warning(f"Lost the lease on {len(photo_uids) - result.rowcount} photos")
+            return result.rowcount
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error renewing leases: {str(e)}")
+            return 0
+        finally:
+            session.close()
+
+    @metrics.db_operation
+    def reclaim_expired_leases(self) -> int:
+        """
+        Return tasks whose lease has expired, e.g. from a crashed worker, to pending.
+        Tasks without a lease, acquired before leases existed, are returned once
+        they have been processing for longer than a lease, or right away when
+        their start was not recorded either.
+        """
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            result = session.execute(
+                update(self.TaskModel)
+                .where(self.TaskModel.status == 'processing',
+                       or_(self.TaskModel.lease_expires_at < now,
+                           and_(self.TaskModel.lease_expires_at.is_(None),
+                                or_(self.TaskModel.started_at.is_(None),
+                                    self.TaskModel.started_at < now - timedelta(seconds=constants.LEASE_SECONDS)))))
+                .values(status='pending', worker_id=None, started_at=None, lease_expires_at=None)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            if result.rowcount:
+                self.logger.info(f"Reclaimed {result.rowcount} tasks with expired leases")
+            return result.rowcount
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error reclaiming expired leases: {str(e)}")
+            return 0
+        finally:
+            session.close()
+
+    def _keep_leases(self) -> None:
+        last_reclaim = 0.0
+        # Also wakes up to commit the deferred completions on time, leases are renewed every few wakes
+        interval = constants.LEASE_HEARTBEAT_SECONDS
+        if constants.JOB_COMMIT_INTERVAL > 0:
+            interval = min(interval, constants.JOB_COMMIT_INTERVAL)
+        wakes_per_renewal = max(1, round(constants.LEASE_HEARTBEAT_SECONDS / interval))
+        wakes = 0
+        while not self.lease_stop.wait(interval):
+            self.flush()
+            wakes += 1
+            if wakes % wakes_per_renewal:
+                continue
+            self.renew_leases()
+            now = time.monotonic()
+            if constants.LEASE_RECLAIM_SECONDS > 0 and now - last_reclaim >= constants.LEASE_RECLAIM_SECONDS:
+                self.reclaim_expired_leases()
+                last_reclaim = now
+
+    def start_lease_keeper(self) -> None:
+        """Start the background thread renewing this worker's leases and reclaiming expired ones"""
+        if self.lease_thread is not None:
+            return
+        self.lease_stop.clear()
+        self.lease_thread = threading.Thread(target=self._keep_leases, name="lease-keeper", daemon=True)
+        self.lease_thread.start()
+
+    def stop_lease_keeper(self) -> None:
+        if self.lease_thread is None:
+            return
+        self.lease_stop.set()
+        self.lease_thread.join()
+        self.lease_thread = None
+        self.flush()
+
+    @metrics.db_operation
     def cleanup_stale_tasks(self, hours: int = 24) -> None:
         """Clean up tasks that have been stuck in processing state"""
         session = self.Session()
@@ -167,6 +835,7 @@ class PhotoProcessor:
                 task.status = 'pending'
                 task.worker_id = None
                 task.started_at = None
+                task.lease_expires_at = None
             
             session.commit()
         except Exception as e:
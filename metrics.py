@@ -0,0 +1,170 @@
+import json
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import constants
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Metrics of this process in the Prometheus text format, scraped from the
+# /metrics endpoint started by serve() when METRICS_PORT is set
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+_registry = []
+_log_lock = threading.Lock()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonic count per label combination"""
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values per label combination, over fixed buckets"""
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # Label values -> (count per bucket with +Inf last, sum, count)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            counts, total, count = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0.0, 0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in the with block, in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+photos_acquired = Counter("photo_ai_photos_acquired_total", "Photos taken on by this worker")
+photos_completed = Counter("photo_ai_photos_completed_total", "Photos captioned and written back")
+photos_failed = Counter("photo_ai_photos_failed_total", "Photos marked failed")
+near_duplicates = Counter("photo_ai_near_duplicate_results_total", "Model results reused from a near-duplicate photo", ["model"])
+stage_seconds = Histogram("photo_ai_stage_seconds", "Latency of a processing step, per photo or per model batch", ["stage"])
+batch_size = Histogram("photo_ai_batch_size", "Number of photos per model batch", ["model"], BATCH_SIZE_BUCKETS)
+db_operation_seconds = Histogram("photo_ai_db_operation_seconds", "Latency of job database operations", ["operation"])
+
+
+def db_operation(func):
+    """Decorator observing the latency of a PhotoProcessor method in db_operation_seconds"""
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        with db_operation_seconds.time(operation=func.__name__):
+            return func(*args, **kwargs)
+    return timed
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def record_batch(**fields):
+    """
+    Append a structured record of a batch to METRICS_LOG, one JSON object per
+    line, stamped with the time and the node name. Nothing is written when
+    METRICS_LOG is not set.
+    """
+    if not constants.METRICS_LOG:
+        return
+    record = {"time": datetime.now(timezone.utc).isoformat(), "node": constants.NODE_NAME, **fields}
+    try:
+        with _log_lock, open(constants.METRICS_LOG, "a") as file:
+            file.write(json.dumps(record) + "\n")
+    except OSError as e:
+        logger.error(f"Error writing batch record to {constants.METRICS_LOG}: {e}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="0.0.0.0"):
+    """
+    Serve /metrics on a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server, None if it could not be started.
+    """
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        logger.error(f"Error starting the metrics endpoint on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,88 @@
+import io
+import numpy as np
+import requests
+import constants
+from preprocess import to_model_input
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RemoteModel:
+    """
+    Client of one of the models of a model_server.py, with the same interface
+    as the local model.
+
+    The server's settings are checked against the worker's on creation, so
+    the results cached by the worker are keyed by what actually produced them.
+    """
+
+    kind = None
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+        self.session = requests.Session()
+        response = self.session.get(f"{self.url}/info", timeout=constants.HTTP_CONNECT_TIMEOUT)
+        response.raise_for_status()
+        info = response.json()[self.kind]
+        self.check(info)
+        self.model_name = info['model_name']
+        self.model_version = info['model_version']
+        self.input_size = info['input_size']
+        self.spec = info['spec']
+
+    def check(self, info):
+        pass
+
+    def preprocess_spec(self):
+        return dict(self.spec)
+
+    def infer(self, images=None, pixel_values=None):
+        """
+        Run a batch on the server.
+
+        Returns:
+            list: One result per image, None on error.
+        """
+        try:
+            if pixel_values is None:
+                pixel_values = np.stack([to_model_input(image.convert("RGB"), self.spec) for image in images])
+            buffer = io.BytesIO()
+            np.save(buffer, np.ascontiguousarray(pixel_values, dtype=np.float32), allow_pickle=False)
+            # No read timeout, a large batch can take minutes on a CPU
+            response = self.session.post(f"{self.url}/{self.kind}", data=buffer.getvalue(),
+                                         headers={"Content-Type": "application/octet-stream"},
+                                         timeout=(constants.HTTP_CONNECT_TIMEOUT, None))
+            response.raise_for_status()
+            return response.json()['results']
+        except Exception as e:
+            logger.error(f"Error running {self.kind} on the model server {self.url}: {str(e)}")
+            return None
+
+
+class RemoteDescriptionGenerator(RemoteModel):
+    kind = 'caption'
+
+    def check(self, info):
+        expected = (constants.CAPTION_MODEL, constants.CAPTION_PROFILE, constants.CAPTION_BACKEND)
+        served = (info.get('model'), info['profile'], info['backend'])
+        if served != expected:
+            raise ValueError(f"the server runs {served[0]} profile {served[1]} with backend {served[2]}, "
+                             f"expected {expected[0]} profile {expected[1]} with {expected[2]}")
+
+    def generate(self, images=None, pixel_values=None):
+        return self.infer(images, pixel_values)
+
+
+class RemoteClassifier(RemoteModel):
+    kind = 'classify'
+
+    def check(self, info):
+        expected = (constants.YOLO_MODEL, constants.YOLO_BACKEND, constants.YOLO_CONFIDENCE)
+        served = (info.get('model'), info['backend'], info['confidence'])
+        if served != expected:
+            raise ValueError(f"the server runs YOLO model {served[0]} with backend {served[1]} at confidence {served[2]}, "
+                             f"expected {expected[0]} with {expected[1]} at {expected[2]}")
+
+    def classify(self, images=None, pixel_values=None):
+        return self.infer(images, pixel_values) or []
@@ -0,0 +1,115 @@
+import io
+import sys
+import json
+import threading
+import numpy as np
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import constants
+from detection import Kosmos2DescriptionGenerator, Florence2DescriptionGenerator, Classifier
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Long-lived process keeping the caption and YOLO models loaded, so that short
+# runs of worker.py started with MODEL_SERVER_URL skip loading them. Workers
+# send batches of preprocessed pixel values and get the captions and labels
+# back. Start it with the same model, profile and backend settings as the
+# workers.
+#
+# GET  /info      models, versions and preprocessing specs
+# POST /caption   .npy float32 batch -> {"results": [caption, ...]}
+# POST /classify  .npy float32 batch -> {"results": [[label, ...], ...]}
+
+if constants.CAPTION_MODEL == "florence2":
+    caption_processor = Florence2DescriptionGenerator()
+elif constants.CAPTION_MODEL == "kosmos2":
+    caption_processor = Kosmos2DescriptionGenerator()
+else:
+    logger.error(f"Invalid caption model {constants.CAPTION_MODEL}")
+    sys.exit(-1)
+yolo_processor = Classifier()
+
+# Models are not thread safe, each one serves a single request at a time
+caption_lock = threading.Lock()
+classify_lock = threading.Lock()
+
+info = {
+    "caption": {
+        "model": constants.CAPTION_MODEL,
+        "model_name": caption_processor.model_name,
+        "model_version": caption_processor.model_version,
+        "input_size": caption_processor.input_size,
+        "spec": caption_processor.preprocess_spec(),
+        "profile": constants.CAPTION_PROFILE,
+        "backend": constants.CAPTION_BACKEND,
+    },
+    "classify": {
+        "model": constants.YOLO_MODEL,
+        "model_name": yolo_processor.model_name,
+        "model_version": yolo_processor.model_version,
+        "input_size": yolo_processor.input_size,
+        "spec": yolo_processor.preprocess_spec(),
+        "backend": constants.YOLO_BACKEND,
+        "confidence": constants.YOLO_CONFIDENCE,
+    },
+}
+
+
+def caption(pixel_values):
+    with caption_lock:
+        return caption_processor.generate(pixel_values=pixel_values)
+
+
+def classify(pixel_values):
+    with classify_lock:
+        return yolo_processor.classify(pixel_values=pixel_values)
+
+
+class ModelHandler(BaseHTTPRequestHandler):
+    routes = {"/caption": caption, "/classify": classify}
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/info":
+            self._send_json({"error": "not found"}, status=404)
+            return
+        self._send_json(info)
+
+    def do_POST(self):
+        route = self.routes.get(self.path)
+        if route is None:
+            self._send_json({"error": "not found"}, status=404)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            pixel_values = np.load(io.BytesIO(self.rfile.read(length)), allow_pickle=False)
+        except Exception as e:
+            self._send_json({"error": f"invalid batch: {e}"}, status=400)
+            return
+        # The models log and swallow their own errors, returning None or []
+        results = route(pixel_values.astype(np.float32, copy=False))
+        if results is None or len(results) != len(pixel_values):
+            self._send_json({"error": "inference failed"}, status=500)
+            return
+        self._send_json({"results": results})
+
+
+server = ThreadingHTTPServer((constants.MODEL_SERVER_HOST, constants.MODEL_SERVER_PORT), ModelHandler)
+server.daemon_threads = True
+logger.info(f"Serving {caption_processor.model_name} and {yolo_processor.model_name} on "
+            f"http://{constants.MODEL_SERVER_HOST}:{server.server_address[1]}")
+try:
+    server.serve_forever()
+except KeyboardInterrupt:
+    server.shutdown()
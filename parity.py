@@ -0,0 +1,89 @@
+import os
+import sys
+import time
+import argparse
+import difflib
+import numpy as np
+import constants
+from detection import Kosmos2DescriptionGenerator, Florence2DescriptionGenerator, Classifier
+from preprocess import prepare_inputs
+from photoprism_stub import IMAGE_EXTENSIONS
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Compare the captions and labels of the configured CAPTION_BACKEND and
+# YOLO_BACKEND against the fp32 torch baseline on a directory of sample images
+
+parser = argparse.ArgumentParser(description="Check a CPU inference backend against the fp32 baseline")
+parser.add_argument("image_dir")
+parser.add_argument("--caption-backend", default=constants.CAPTION_BACKEND)
+parser.add_argument("--yolo-backend", default=constants.YOLO_BACKEND)
+parser.add_argument("--min-caption-similarity", type=float, default=0.8,
+                    help="Fail when the mean caption similarity to the baseline is lower")
+parser.add_argument("--min-label-agreement", type=float, default=0.9,
+                    help="Fail when the mean label agreement with the baseline is lower")
+args = parser.parse_args()
+
+if constants.CAPTION_MODEL == "florence2":
+    generator_class = Florence2DescriptionGenerator
+elif constants.CAPTION_MODEL == "kosmos2":
+    generator_class = Kosmos2DescriptionGenerator
+else:
+    logger.error(f"Invalid caption model {constants.CAPTION_MODEL}")
+    sys.exit(-1)
+
+paths = [
+    os.path.join(args.image_dir, filename) for filename in sorted(os.listdir(args.image_dir))
+    if filename.lower().endswith(IMAGE_EXTENSIONS)
+]
+if not paths:
+    logger.error(f"No images found in {args.image_dir}")
+    sys.exit(-1)
+
+def run(caption_backend, yolo_backend):
+    """Caption and classify every sample image, returns (captions, labels, seconds)"""
+    generator = generator_class(backend=caption_backend)
+    classifier = Classifier(backend=yolo_backend)
+    specs = {'caption': generator.preprocess_spec(), 'classify': classifier.preprocess_spec()}
+    images = [prepare_inputs(path, specs) for path in paths]
+
+    start_time = time.time()
+    captions = []
+    for image in images:
+        # One image at a time, so timings are comparable across backends
+        captions.extend(generator.generate(pixel_values=image['caption'][None]) or [None])
+    labels = classifier.classify(pixel_values=np.stack([image['classify'] for image in images]))
+    return captions, labels, time.time() - start_time
+
+def label_agreement(expected, actual):
+    expected, actual = set(expected), set(actual)
+    if not expected and not actual:
+        return 1.0
+    return len(expected & actual) / len(expected | actual)
+
+logger.info(f"Running the fp32 baseline on {len(paths)} images")
+base_captions, base_labels, base_seconds = run('torch', 'torch')
+logger.info(f"Running caption backend {args.caption_backend} and YOLO backend {args.yolo_backend}")
+captions, labels, seconds = run(args.caption_backend, args.yolo_backend)
+
+caption_scores, label_scores = [], []
+for path, base_caption, caption, base_label, label in zip(paths, base_captions, captions, base_labels, labels):
+    caption_score = difflib.SequenceMatcher(None, base_caption or '', caption or '').ratio()
+    label_score = label_agreement(base_label, label)
+    caption_scores.append(caption_score)
+    label_scores.append(label_score)
+    if caption_score < 1.0 or label_score < 1.0:
+        logger.info(f"{os.path.basename(path)}: caption similarity {caption_score:.2f}, label agreement {label_score:.2f}\n"
+                    f"  baseline: {base_caption} {base_label}\n"
+                    f"  backend:  {caption} {label}")
+
+caption_similarity = sum(caption_scores) / len(caption_scores)
+label_similarity = sum(label_scores) / len(label_scores) if label_scores else 0.0
+logger.info(f"Caption similarity {caption_similarity:.3f}, label agreement {label_similarity:.3f}, "
+            f"{base_seconds:.1f}s baseline vs {seconds:.1f}s backend ({base_seconds / max(seconds, 1e-9):.2f}x)")
+
+if caption_similarity < args.min_caption_similarity or label_similarity < args.min_label_agreement:
+    logger.error("Backend outputs diverge from the baseline beyond the allowed thresholds")
+    sys.exit(1)
@@ -0,0 +1,203 @@
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import logging
+logger = logging.getLogger(__name__)
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.heic', '.bmp', '.gif', '.tif', '.tiff')
+DOWNLOAD_TOKEN = "stubtoken"
+PREVIEW_TOKEN = "stubpreview"
+
+
+class PhotoLibrary:
+    """
+    In-memory PhotoPrism library built from a directory of images, each image
+    is listed copies times under different UIDs
+    """
+
+    def __init__(self, image_dir, copies=1):
+        self.lock = threading.Lock()
+        self.photos = []
+        self.files = {}
+        self.updates = 0
+        now = datetime.now(timezone.utc)
+
+        hashes = {}
+        for filename in sorted(os.listdir(image_dir)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(image_dir, filename)
+            with open(path, "rb") as file:
+                hashes[filename] = hashlib.sha1(file.read()).hexdigest()
+            self.files[hashes[filename]] = path
+
+        filenames = list(hashes)
+        for idx in range(len(filenames) * max(1, copies)):
+            filename = filenames[idx % len(filenames)]
+            photo_hash = hashes[filename]
+            self.photos.append({
+                "UID": f"ps{idx:014d}",
+                "Hash": photo_hash,
+                "FileName": filename,
+                "Caption": "",
+                "CaptionSrc": "",
+                "Details": {"Keywords": "", "KeywordsSrc": ""},
+                # Listed newest first, like PhotoPrism's order=added
+                "CreatedAt": (now - timedelta(seconds=idx)).strftime(TIME_FORMAT),
+                "UpdatedAt": now.strftime(TIME_FORMAT),
+            })
+        self.by_uid = {photo["UID"]: photo for photo in self.photos}
+
+    def list(self, count, offset, order="added", updated=None):
+        with self.lock:
+            photos = self.photos
+            if updated:
+                # Timestamps share one format, so they compare as strings
+                photos = [photo for photo in photos if photo["UpdatedAt"] >= updated]
+            if order == "updated":
+                photos = sorted(photos, key=lambda photo: photo["UpdatedAt"], reverse=True)
+            # Search results have no Details, like PhotoPrism's, only GET returns them
+            return [{key: value for key, value in photo.items() if key != "Details"}
+                    for photo in photos[offset:offset + count]]
+
+    def get(self, photo_uid):
+        with self.lock:
+            photo = self.by_uid.get(photo_uid)
+            return json.loads(json.dumps(photo)) if photo else None
+
+    def update(self, photo_uid, payload):
+        with self.lock:
+            photo = self.by_uid.get(photo_uid)
+            if photo is None:
+                return None
+            details = payload.pop("Details", None)
+            photo.update(payload)
+            if details:
+                photo["Details"].update(details)
+            photo["UpdatedAt"] = datetime.now(timezone.utc).strftime(TIME_FORMAT)
+            self.updates += 1
+            return json.loads(json.dumps(photo))
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Implements the /api/v1/photos, /api/v1/photos/{uid} (GET and PUT), /api/v1/dl/{hash} and /api/v1/t/{hash}/{token}/{size} endpoints"""
+
+    library = None
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_file(self, path):
+        with open(path, "rb") as file:
+            body = file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == "/api/v1/photos":
+            count = int(query.get("count", ["100"])[0])
+            offset = int(query.get("offset", ["0"])[0])
+            order = query.get("order", ["added"])[0]
+            updated = query.get("updated", [None])[0]
+            self._send_json(self.library.list(count, offset, order, updated),
+                            headers={"X-Download-Token": DOWNLOAD_TOKEN, "X-Preview-Token": PREVIEW_TOKEN})
+            return
+
+        if url.path.startswith("/api/v1/photos/"):
+            photo = self.library.get(url.path.rsplit("/", 1)[-1])
+            if photo is None:
+                self._send_json({"error": "not found"}, status=404)
+                return
+            self._send_json(photo)
+            return
+
+        if url.path.startswith("/api/v1/t/"):
+            # /api/v1/t/{hash}/{token}/{size}, the original is served as is whatever the size
+            parts = url.path.split("/")
+            path = self.library.files.get(parts[4]) if len(parts) == 7 else None
+            if path is None or parts[5] != PREVIEW_TOKEN:
+                self._send_json({"error": "not found"}, status=404)
+                return
+            self._send_file(path)
+            return
+
+        if url.path.startswith("/api/v1/dl/"):
+            path = self.library.files.get(url.path.rsplit("/", 1)[-1])
+            if path is None or query.get("t", [None])[0] != DOWNLOAD_TOKEN:
+                self._send_json({"error": "not found"}, status=404)
+                return
+            self._send_file(path)
+            return
+
+        self._send_json({"error": "not found"}, status=404)
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        if not url.path.startswith("/api/v1/photos/"):
+            self._send_json({"error": "not found"}, status=404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        photo = self.library.update(url.path.rsplit("/", 1)[-1], payload)
+        if photo is None:
+            self._send_json({"error": "not found"}, status=404)
+            return
+        self._send_json(photo)
+
+
+def serve(image_dir, host="127.0.0.1", port=0, copies=1):
+    """
+    Start a stub PhotoPrism server in a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server, its root URL is
+        http://{server.server_address[0]}:{server.server_address[1]}.
+    """
+    handler = type("BoundStubHandler", (StubHandler,), {"library": PhotoLibrary(image_dir, copies)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="photoprism-stub", daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub PhotoPrism API serving a directory of images")
+    parser.add_argument("image_dir")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2342)
+    parser.add_argument("--copies", type=int, default=1, help="List every image this many times")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = serve(args.image_dir, args.host, args.port, args.copies)
+    logger.info(f"Serving {len(server.RequestHandlerClass.library.photos)} photos on "
+                f"http://{args.host}:{server.server_address[1]}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
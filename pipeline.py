@@ -0,0 +1,236 @@
+import queue
+import threading
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Sentinel passed down the queues to tell a stage that its producer is done
+_STOP = object()
+
+
+def prefetch(iterable, size=1):
+    """
+    Iterate over iterable on a background thread, staying up to size items
+    ahead of the caller. An exception raised by iterable is raised again in
+    the caller once the items before it are consumed, as without prefetching.
+    """
+    items = queue.Queue(maxsize=max(1, size))
+    errors = []
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            items.put(_STOP)
+
+    threading.Thread(target=produce, name="prefetch", daemon=True).start()
+    while True:
+        item = items.get()
+        if item is _STOP:
+            if errors:
+                raise errors[0]
+            return
+        yield item
+
+
+class StageStats:
+    """
+    Counters for a single pipeline stage.
+
+    idle_time is the time workers spent waiting for input, blocked_time is the
+    time spent waiting for room in the next stage's queue. A stage with a high
+    idle time is starved by its upstream, a stage with a high blocked time is
+    held back by its downstream, and the bottleneck is the one with neither.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.busy_time = 0.0
+        self.idle_time = 0.0
+        self.blocked_time = 0.0
+        self.max_queue_depth = 0
+        self.lock = threading.Lock()
+
+    def add(self, processed=0, failed=0, busy=0.0, idle=0.0, blocked=0.0):
+        with self.lock:
+            self.processed += processed
+            self.failed += failed
+            self.busy_time += busy
+            self.idle_time += idle
+            self.blocked_time += blocked
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+            return {
+                "stage": self.name,
+                "queue_depth": queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "processed": self.processed,
+                "failed": self.failed,
+                "busy": round(self.busy_time, 2),
+                "idle": round(self.idle_time, 2),
+                "blocked": round(self.blocked_time, 2),
+            }
+
+
+class Stage:
+    """
+    A pipeline stage running `func` on `workers` threads.
+
+    Without batch_size, func receives a single item and returns the item to
+    pass on (or None to drop it). With batch_size set, func receives a list of
+    up to batch_size items and returns the list of items to pass on. A batch
+    waits up to batch_timeout seconds after its first item for the rest of
+    its items, so a stage fed one item at a time still gets full batches.
+    Exceptions are caught per call and handed to on_error with the item (or
+    list of items) that failed.
+    """
+
+    def __init__(self, name, func, workers=1, queue_size=16, batch_size=None, batch_timeout=0, on_error=None):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.batched = batch_size is not None
+        self.batch_size = max(1, batch_size or 1)
+        self.batch_timeout = max(0, batch_timeout)
+        self.on_error = on_error
+        self.input = queue.Queue(maxsize=max(1, queue_size))
+        self.stats = StageStats(name)
+        self.next = None
+        self._alive = self.workers
+        self._alive_lock = threading.Lock()
+
+    def _put(self, item):
+        if self.next is None:
+            return
+        start = time.time()
+        self.next.input.put(item)
+        self.stats.add(blocked=time.time() - start)
+
+    def _get_batch(self):
+        start = time.time()
+        item = self.input.get()
+        self.stats.add(idle=time.time() - start)
+        if item is _STOP:
+            return None
+
+        items = [item]
+        deadline = time.time() + self.batch_timeout
+        while len(items) < self.batch_size:
+            start = time.time()
+            try:
+                if deadline > start:
+                    item = self.input.get(timeout=deadline - start)
+                else:
+                    item = self.input.get_nowait()
+            except queue.Empty:
+                break
+            finally:
+                self.stats.add(idle=time.time() - start)
+            if item is _STOP:
+                # Leave the sentinel for the next get() so the batch in hand is still processed
+                self.input.put(_STOP)
+                break
+            items.append(item)
+        return items
+
+    def _run(self):
+        while True:
+            items = self._get_batch()
+            if items is None:
+                break
+
+            start = time.time()
+            try:
+                if self.batched:
+                    results = self.func(items) or []
+                else:
+                    result = self.func(items[0])
+                    results = [] if result is None else [result]
+                self.stats.add(processed=len(items), busy=time.time() - start)
+            except Exception as e:
+                logger.error(f"Stage {self.name} failed: {e}")
+                self.stats.add(failed=len(items), busy=time.time() - start)
+                if self.on_error:
+                    for item in items:
+                        self.on_error(item, e)
+                continue
+
+            for result in results:
+                self._put(result)
+
+        # The last worker out tells every worker of the next stage to stop
+        with self._alive_lock:
+            self._alive -= 1
+            last = self._alive == 0
+        if last and self.next is not None:
+            for _ in range(self.next.workers):
+                self.next.input.put(_STOP)
+
+    def start(self):
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        return threads
+
+
+class Pipeline:
+    """
+    Chain of stages connected by bounded queues.
+
+    Items produced by the source iterable are fed into the first stage from
+    the calling thread, so the source naturally blocks when the pipeline is
+    full. Per-stage counters are logged every stats_interval seconds and once
+    more when the pipeline has drained.
+    """
+
+    def __init__(self, stages, stats_interval=30):
+        self.stages = stages
+        self.stats_interval = stats_interval
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def stats(self):
+        return [stage.stats.snapshot(stage.input.qsize()) for stage in self.stages]
+
+    def log_stats(self):
+        for stat in self.stats():
+            logger.info(
+                f"Stage {stat['stage']}: queue {stat['queue_depth']} (max {stat['max_queue_depth']}), "
+                f"processed {stat['processed']}, failed {stat['failed']}, busy {stat['busy']}s, "
+                f"idle {stat['idle']}s, blocked {stat['blocked']}s"
+            )
+
+    def _report(self, done):
+        while not done.wait(self.stats_interval):
+            self.log_stats()
+
+    def run(self, source):
+        threads = []
+        for stage in self.stages:
+            threads.extend(stage.start())
+
+        done = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(done,), name="pipeline-stats", daemon=True)
+        reporter.start()
+
+        first = self.stages[0]
+        try:
+            for item in source:
+                first.input.put(item)
+        finally:
+            for _ in range(first.workers):
+                first.input.put(_STOP)
+            for thread in threads:
+                thread.join()
+            done.set()
+            self.log_stats()
@@ -0,0 +1,199 @@
+import io
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image, ImageOps
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def load_image(source, draft_size=None):
+    """
+    Decode an image to RGB with its EXIF orientation applied.
+
+    Args:
+        source: File path or file object of the image.
+        draft_size (int): Let JPEGs decode at the smallest DCT scale still covering this size.
+
+    Returns:
+        Image: The decoded RGB image.
+    """
+    image = Image.open(source)
+    if draft_size:
+        image.draft("RGB", (draft_size, draft_size))
+    image = ImageOps.exif_transpose(image)
+    return image.convert("RGB")
+
+
+def to_model_input(image, spec):
+    """
+    Resize, crop and normalize an image the way a model's processor does.
+
+    Args:
+        image (Image): RGB image.
+        spec (dict): Preprocessing spec of the model, see Classifier.preprocess_spec.
+
+    Returns:
+        ndarray: float32 CHW array ready to be stacked into a batch.
+    """
+    if spec.get("shortest_edge"):
+        width, height = image.size
+        scale = spec["shortest_edge"] / min(width, height)
+        image = image.resize((max(1, round(width * scale)), max(1, round(height * scale))), Image.BICUBIC)
+    else:
+        height, width = spec["size"]
+        image = image.resize((width, height), Image.BICUBIC)
+
+    if spec.get("crop"):
+        crop_height, crop_width = spec["crop"]
+        width, height = image.size
+        left, top = (width - crop_width) // 2, (height - crop_height) // 2
+        image = image.crop((left, top, left + crop_width, top + crop_height))
+
+    array = np.asarray(image, dtype=np.float32) * spec["rescale"]
+    array = (array - np.asarray(spec["mean"], dtype=np.float32)) / np.asarray(spec["std"], dtype=np.float32)
+    return np.ascontiguousarray(array.transpose(2, 0, 1))
+
+
+def master_size(specs):
+    """Shortest edge an image needs to cover the input of every model described in specs"""
+    return max(spec.get("shortest_edge") or max(spec["size"]) for spec in specs.values())
+
+
+def downscale(image, size):
+    """
+    Shrink an image so that its shortest edge is size, images already smaller are returned as is.
+    """
+    width, height = image.size
+    if min(width, height) <= size:
+        return image
+    scale = size / min(width, height)
+    return image.resize((max(size, round(width * scale)), max(size, round(height * scale))),
+                        Image.BICUBIC, reducing_gap=3.0)
+
+
+def difference_hash(image):
+    """
+    64 bit perceptual hash of an image, robust to resizing, recompression and
+    small edits: bit i is set where a pixel of the 9x8 grayscale thumbnail is
+    brighter than its left neighbour.
+
+    Returns:
+        ndarray: The hash as an array of a single uint64.
+    """
+    pixels = np.asarray(image.convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).view(np.uint64)
+
+
+def prepare_inputs(source, specs, draft_size=None, phash=False):
+    """
+    Decode an image once and compute the input of every model from it.
+
+    The decoded image is first downscaled to a master just large enough for
+    every model, the full resolution pixels are released right away and each
+    model's input is derived from the master.
+
+    Args:
+        source: File path or file object of the image.
+        specs (dict): Preprocessing spec per model name.
+        draft_size (int): See load_image.
+        phash (bool): Also compute the difference_hash of the master, under the 'phash' key.
+
+    Returns:
+        dict: float32 CHW array per model name.
+    """
+    image = downscale(load_image(source, draft_size), master_size(specs))
+    arrays = {name: to_model_input(image, spec) for name, spec in specs.items()}
+    if phash:
+        arrays['phash'] = difference_hash(image)
+    image.close()
+    return arrays
+
+
+def _prepare(source, specs, draft_size, phash):
+    # Runs in a pool process: the model inputs are written to a shared memory
+    # block and only its name and layout travel back to the parent
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    arrays = prepare_inputs(source, specs, draft_size, phash)
+
+    block = shared_memory.SharedMemory(create=True, size=max(1, sum(array.nbytes for array in arrays.values())))
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf, offset=offset)[...] = array
+        layout[name] = (offset, array.shape, array.dtype.str)
+        offset += array.nbytes
+    block.close()
+    return block.name, layout
+
+
+def _collect(result):
+    name, layout = result
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return {
+            key: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset).copy()
+            for key, (offset, shape, dtype) in layout.items()
+        }
+    finally:
+        block.close()
+        block.unlink()
+
+
+def _warm_up():
+    return True
+
+
+class Preprocessor:
+    """
+    Decode and preprocess images in a pool of worker processes.
+
+    Each image is decoded, EXIF-oriented and turned into the input of every
+    model described in specs, so JPEG decoding, resizing and normalization run
+    on all cores instead of serializing with inference on the main thread.
+    Compressed image bytes or file paths go to the pool, model inputs come
+    back through shared memory rather than being pickled.
+
+    The pool is forked as soon as it is created, create it before loading the
+    models so the pool processes stay small.
+    """
+
+    def __init__(self, workers):
+        # Pool processes must share the parent's resource tracker, or each of them
+        # would report the blocks it created and the parent unlinked as leaked
+        resource_tracker.ensure_running()
+        context = multiprocessing.get_context("fork")
+        self.pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        # Fork every pool process now, while the parent is still small
+        for future in [self.pool.submit(_warm_up) for _ in range(workers)]:
+            future.result()
+
+    def submit(self, source, specs, draft_size=None, phash=False):
+        """
+        Start preparing an image in a pool process without waiting for it, so
+        the images of a batch are all submitted before the first one is
+        collected and decode in parallel. The source must be kept until the
+        image is collected.
+
+        Returns:
+            Future: To pass to collect.
+        """
+        if not isinstance(source, str):
+            source.seek(0)
+            source = source.read()
+        return self.pool.submit(_prepare, source, specs, draft_size, phash)
+
+    def collect(self, future):
+        """Wait for an image started with submit, returns the same as prepare_inputs"""
+        return _collect(future.result())
+
+    def prepare(self, source, specs, draft_size=None, phash=False):
+        """Same as prepare_inputs, run in a pool process"""
+        return self.collect(self.submit(source, specs, draft_size, phash))
+
+    def shutdown(self):
+        """Wait for the images in hand and stop the pool processes"""
+        self.pool.shutdown()
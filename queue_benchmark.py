@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import json
+import argparse
+import tempfile
+import multiprocessing
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Measure how fast the job database hands out and completes tasks, with
+# several processes sharing it the way the workers of supervisor.py do, and
+# check that no task is acquired twice. Settings are passed as KEY=VALUE pairs,
+# so the SQLite tuning can be compared with the SQLite defaults:
+#
+#   uv run queue_benchmark.py --tasks 20000 --processes 4
+#   uv run queue_benchmark.py --tasks 20000 --processes 4 SQLITE_JOURNAL_MODE=DELETE SQLITE_SYNCHRONOUS=FULL
+
+parser = argparse.ArgumentParser(description="Benchmark acquisitions and completions of the job database")
+parser.add_argument("settings", nargs="*", metavar="KEY=VALUE", help="Environment overrides for the job database")
+parser.add_argument("--tasks", type=int, default=10000, help="Number of tasks to process")
+parser.add_argument("--processes", type=int, default=4, help="Number of processes sharing the job database")
+parser.add_argument("--mode", choices=("acquire", "claim"), default="acquire",
+                    help="acquire: every process walks the listing and acquires pages of photos like a listing worker, "
+                         "claim: processes claim seeded tasks like QUEUE_MODE workers")
+parser.add_argument("--page-size", type=int, default=100, help="Photos per acquired page or claim")
+parser.add_argument("--complete-batch", type=int, default=1,
+                    help="Photos marked complete per call, 1 for a call per photo like failed photos")
+parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+args = parser.parse_intermixed_args()
+
+logging.basicConfig(level=logging.WARNING)
+
+workdir = tempfile.mkdtemp(prefix="photo-ai-queue-benchmark-")
+os.environ.update({
+    "DISTRIBUTED_PROCESSING": "0",
+    "DB_PATH": os.path.join(workdir, "photo_tasks.db"),
+})
+for setting in args.settings:
+    key, _, value = setting.partition("=")
+    os.environ[key] = value
+
+# Imported once the environment is in place, as constants is read at import
+import constants
+from job_queue import PhotoProcessor
+
+# Settings must not point the run at a real job database, it would process or complete real tasks
+if constants.DP or os.path.dirname(os.path.abspath(constants.DB_PATH)) != workdir:
+    logger.error("Only runs on its own scratch SQLite job database, do not set DISTRIBUTED_PROCESSING or DB_PATH")
+    sys.exit(-1)
+
+photo_uids = [f"pq{index:014d}" for index in range(args.tasks)]
+
+
+def complete(processor, acquired):
+    for start in range(0, len(acquired), args.complete_batch):
+        processor.mark_complete_many(acquired[start:start + args.complete_batch])
+
+
+def run(index, results):
+    """Process tasks until none are left, sending back the UIDs this process acquired"""
+    processor = PhotoProcessor(worker_id=f"benchmark-{index}")
+    acquired_uids = []
+    if args.mode == "claim":
+        while True:
+            photos = processor.claim_tasks(args.page_size, include_captioned=True)
+            if not photos:
+                break
+            acquired = [photo['UID'] for photo in photos]
+            complete(processor, acquired)
+            acquired_uids.extend(acquired)
+    else:
+        # Every process lists the whole library, starting at a different page like workers started apart
+        pages = [photo_uids[start:start + args.page_size] for start in range(0, len(photo_uids), args.page_size)]
+        offset = index * len(pages) // args.processes
+        for page in pages[offset:] + pages[:offset]:
+            acquired = processor.try_acquire_photos(page)
+            complete(processor, acquired)
+            acquired_uids.extend(acquired)
+    processor.flush()
+    results.put(acquired_uids)
+
+
+if args.mode == "claim":
+    seeder = PhotoProcessor(worker_id="benchmark-seed")
+    for start in range(0, len(photo_uids), 1000):
+        seeder.seed_tasks([{'UID': photo_uid, 'Hash': photo_uid, 'FileName': f"{photo_uid}.jpg", 'Caption': ""}
+                           for photo_uid in photo_uids[start:start + 1000]])
+    seeder.engine.dispose()
+
+context = multiprocessing.get_context("fork")
+results = context.Queue()
+processes = [context.Process(target=run, args=(index, results)) for index in range(args.processes)]
+start_time = time.perf_counter()
+for process in processes:
+    process.start()
+acquired = [uid for _ in processes for uid in results.get()]
+elapsed = time.perf_counter() - start_time
+for process in processes:
+    process.join()
+
+processor = PhotoProcessor(worker_id="benchmark-check")
+count_start = time.perf_counter()
+counts = processor.get_status_counts() or {}
+count_time = time.perf_counter() - count_start
+
+report = {
+    "settings": dict(setting.partition("=")[::2] for setting in args.settings),
+    "mode": args.mode,
+    "processes": args.processes,
+    "tasks": args.tasks,
+    "acquired": len(acquired),
+    "acquired_twice": len(acquired) - len(set(acquired)),
+    "seconds": round(elapsed, 2),
+    "acquisitions_per_second": round(len(acquired) / max(elapsed, 1e-9), 1),
+    "status_counts": counts,
+    "status_count_ms": round(count_time * 1000, 2),
+}
+
+if args.json:
+    print(json.dumps(report, indent=2))
+else:
+    print(f"{report['acquired']}/{report['tasks']} tasks by {report['processes']} processes in {report['seconds']}s "
+          f"({report['acquisitions_per_second']} acquisitions/s), {report['acquired_twice']} acquired twice")
+    print(f"  tasks per status {counts}, read in {report['status_count_ms']}ms")
+sys.exit(1 if report['acquired_twice'] or len(set(acquired)) != args.tasks else 0)
@@ -0,0 +1,182 @@
+from sqlalchemy import create_engine, Column, String, Text, DateTime, Index, delete, func, select, update
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from datetime import datetime
+import json
+import logging
+import threading
+import numpy as np
+from typing import Any, Dict, List
+
+Base = declarative_base()
+
+class CachedResult(Base):
+    __tablename__ = 'results'
+
+    photo_hash = Column(String(64), primary_key=True)
+    model = Column(String(255), primary_key=True)
+    version = Column(String(64), primary_key=True)
+    profile = Column(String(64), primary_key=True)
+    result = Column(Text, nullable=False)
+    accessed_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_results_accessed_at', 'accessed_at'),
+    )
+
+class ResultCache:
+    """
+    Local store of model results keyed by photo content hash.
+
+    Results are stored per (hash, model, version, profile), so a photo whose
+    file did not change is never downloaded or run through a model again, a
+    duplicate file costs nothing, and changing one model only invalidates the
+    results of that model. Once the cache holds more than max_entries results,
+    the least recently used ones are evicted.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1000000):
+        self.logger = logging.getLogger(__name__)
+        self.max_entries = max_entries
+        # Results written since the cache size was last checked
+        self.written = 0
+        self.engine = create_engine(f"sqlite:///{path}", connect_args={'timeout': 30})
+        Base.metadata.create_all(self.engine)
+        self.Session = sessionmaker(bind=self.engine)
+
+    def get_many(self, model: str, version: str, profile: str, photo_hashes: List[str]) -> Dict[str, Any]:
+        """
+        Look up the results of a model for several photos.
+
+        Returns:
+            dict: Result per photo hash found in the cache, empty on error.
+        """
+        photo_hashes = [photo_hash for photo_hash in set(photo_hashes) if photo_hash]
+        if not photo_hashes:
+            return {}
+
+        session = self.Session()
+        try:
+            key = (CachedResult.model == model, CachedResult.version == version, CachedResult.profile == profile)
+            rows = session.execute(
+                select(CachedResult.photo_hash, CachedResult.result)
+                .where(CachedResult.photo_hash.in_(photo_hashes), *key)
+            ).all()
+            results = {photo_hash: json.loads(result) for photo_hash, result in rows}
+            if results:
+                session.execute(
+                    update(CachedResult)
+                    .where(CachedResult.photo_hash.in_(list(results)), *key)
+                    .values(accessed_at=datetime.utcnow())
+                    .execution_options(synchronize_session=False)
+                )
+                session.commit()
+            return results
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error reading cached results of {model}: {str(e)}")
+            return {}
+        finally:
+            session.close()
+
+    def put_many(self, model: str, version: str, profile: str, results: Dict[str, Any]) -> bool:
+        """Store the results of a model, keyed by photo hash"""
+        rows = [
+            {'photo_hash': photo_hash, 'model': model, 'version': version, 'profile': profile,
+             'result': json.dumps(result), 'accessed_at': datetime.utcnow()}
+            for photo_hash, result in results.items() if photo_hash
+        ]
+        if not rows:
+            return True
+
+        session = self.Session()
+        try:
+            stmt = sqlite_insert(CachedResult).values(rows)
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['photo_hash', 'model', 'version', 'profile'],
+                set_={'result': stmt.excluded.result, 'accessed_at': stmt.excluded.accessed_at},
+            ))
+            session.commit()
+            self.written += len(rows)
+            if self.written >= 1000:
+                self.written = 0
+                self._evict(session)
+            return True
+        except Exception as e:
+            session.rollback()
+            self.logger.error(f"Error caching results of {model}: {str(e)}")
+            return False
+        finally:
+            session.close()
+
+    def _evict(self, session) -> None:
+        # Counting is a full scan, it runs every 1000 writes and evicts down to 90% of the limit
+        total = session.execute(select(func.count()).select_from(CachedResult)).scalar()
+        if total <= self.max_entries:
+            return
+        cutoff = session.execute(
+            select(CachedResult.accessed_at)
+            .order_by(CachedResult.accessed_at.desc())
+            .offset(int(self.max_entries * 0.9))
+            .limit(1)
+        ).scalar()
+        result = session.execute(delete(CachedResult).where(CachedResult.accessed_at <= cutoff))
+        session.commit()
+        self.logger.info(f"Evicted {result.rowcount} cached results")
+
+
+class NearDuplicateIndex:
+    """
+    In-memory index of the most recent results of a model, keyed by perceptual
+    hash, see preprocess.difference_hash.
+
+    Burst shots, edited copies and re-exports have different content hashes
+    but nearly the same perceptual hash, so the result of an earlier photo
+    within max_distance bits of a new one is reused for it. Only the last
+    max_entries results are kept, a lookup compares against all of them.
+
+    The hashes of featureless photos, such as plain dark or sky shots, are
+    nearly all zeros or all ones and match each other regardless of content,
+    they are neither indexed nor looked up.
+    """
+
+    def __init__(self, max_distance: int = 4, max_entries: int = 10000):
+        self.max_distance = max_distance
+        self.hashes = np.zeros(max(1, max_entries), dtype=np.uint64)
+        self.results: List[Any] = [None] * len(self.hashes)
+        # Slots used so far and next slot to overwrite
+        self.size = 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def featureless(self, phash: int) -> bool:
+        set_bits = bin(phash).count('1')
+        return set_bits <= self.max_distance or set_bits >= 64 - self.max_distance
+
+    def add(self, phash: int, result: Any) -> None:
+        if self.featureless(phash):
+            return
+        with self.lock:
+            self.hashes[self.next] = phash
+            self.results[self.next] = result
+            self.next = (self.next + 1) % len(self.hashes)
+            self.size = min(self.size + 1, len(self.hashes))
+
+    def find(self, phash: int) -> Any:
+        """
+        Look up the result of the nearest indexed photo.
+
+        Returns:
+            The result, None when no photo is within max_distance bits.
+        """
+        if self.featureless(phash):
+            return None
+        with self.lock:
+            if not self.size:
+                return None
+            distances = np.bitwise_count(self.hashes[:self.size] ^ np.uint64(phash))
+            nearest = int(np.argmin(distances))
+            if distances[nearest] > self.max_distance:
+                return None
+            return self.results[nearest]
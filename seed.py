@@ -0,0 +1,31 @@
+import sys
+import utils
+import constants
+from job_queue import PhotoProcessor
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+headers = {
+    "X-Auth-Token": constants.PHOTOPRISM_TOKEN,
+}
+
+# Enumerate the library once into the job database, workers started with
+# QUEUE_MODE=1 then claim pending tasks from there instead of listing PhotoPrism
+processor = PhotoProcessor(worker_id=constants.NODE_NAME)
+
+seeded = 0
+for photo_response, photos in utils.photo_pages(constants.PHOTO_FILTER, constants.SEED_PAGE_SIZE, headers=headers):
+    if photo_response is None:
+        logger.error(f"Error while seeding after {seeded} photos, will stop here")
+        sys.exit(-1)
+
+    if processor.seed_tasks(photos) < 0:
+        logger.error(f"Error while seeding after {seeded} photos, will stop here")
+        sys.exit(-1)
+
+    seeded += len(photos)
+    logger.info(f"Seeded {seeded} photos")
+
+logger.info(f"Seeding complete, {seeded} photos in the queue")
@@ -0,0 +1,150 @@
+import os
+import sys
+import time
+import signal
+import socket
+import subprocess
+import constants
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Run WORKER_PROCESSES copies of worker.py on this host against the shared job
+# database. Each worker gets its own worker id, a device from WORKER_DEVICES and
+# a share of the CPU cores, crashed workers are restarted and SIGTERM drains
+# every worker before exiting.
+
+# Crash loops back off up to this delay, a worker that ran longer resets the backoff
+MAX_RESTART_DELAY = 300
+
+
+class WorkerProcess:
+    """A worker.py child process and its restart state"""
+
+    def __init__(self, index, env):
+        self.index = index
+        self.env = env
+        self.process = None
+        self.started_at = 0.0
+        self.restart_delay = constants.WORKER_RESTART_DELAY
+        self.restart_at = 0.0
+        self.done = False
+        self.failed = False
+
+    @property
+    def name(self):
+        return self.env["NODE_NAME"]
+
+    def start(self):
+        worker = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+        # In a session of its own, so a Ctrl-C reaches the supervisor only and the worker is drained instead
+        self.process = subprocess.Popen([sys.executable, worker], env=self.env, start_new_session=True)
+        self.started_at = time.time()
+        logger.info(f"Started worker {self.name} (pid {self.process.pid})")
+
+    def poll(self, draining):
+        """
+        Check on the worker, scheduling a restart if it crashed. A worker that
+        stopped on an invalid setting, see CONFIG_ERROR_EXIT_CODE, is not restarted.
+
+        Returns:
+            bool: True while the worker is running or due to be restarted.
+        """
+        if self.done:
+            return False
+        if self.process is None:
+            if not draining and time.time() >= self.restart_at:
+                self.start()
+            return not draining
+
+        code = self.process.poll()
+        if code is None:
+            return True
+        self.process = None
+        if code == 0 or draining:
+            logger.info(f"Worker {self.name} exited with code {code}")
+            self.done = True
+            return False
+        if code == constants.CONFIG_ERROR_EXIT_CODE:
+            # A restart would run into the same invalid setting, other errors such as a
+            # job database outage are worth restarting for
+            logger.error(f"Worker {self.name} stopped on an invalid setting, not restarting it, see its log")
+            self.done = True
+            self.failed = True
+            return False
+
+        if time.time() - self.started_at > MAX_RESTART_DELAY:
+            self.restart_delay = constants.WORKER_RESTART_DELAY
+        logger.error(f"Worker {self.name} crashed with code {code}, restarting in {self.restart_delay} seconds")
+        self.restart_at = time.time() + self.restart_delay
+        self.restart_delay = min(self.restart_delay * 2, MAX_RESTART_DELAY)
+        return True
+
+    def signal(self, signum):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signum)
+
+
+def worker_env(index, devices, threads):
+    """Environment of the worker at index, derived from the supervisor's own"""
+    env = dict(os.environ)
+    env["NODE_NAME"] = f"{constants.NODE_NAME or socket.gethostname()}-{index}"
+
+    if devices:
+        device = devices[index % len(devices)]
+        if device.startswith("cuda"):
+            # The worker only sees its GPU, which it addresses as cuda
+            env["CUDA_VISIBLE_DEVICES"] = device.partition(":")[2] or "0"
+            env["YOLO_DEVICE"] = "cuda"
+        else:
+            env["CUDA_VISIBLE_DEVICES"] = ""
+            env["YOLO_DEVICE"] = "cpu"
+
+    # Without a budget every worker would start one thread per core and they would thrash
+    if not constants.TORCH_INTRA_OP_THREADS:
+        env["TORCH_INTRA_OP_THREADS"] = str(threads)
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS"):
+        env.setdefault(name, str(threads))
+
+    if constants.METRICS_PORT:
+        env["METRICS_PORT"] = str(constants.METRICS_PORT + index)
+    return env
+
+
+processes = max(1, constants.WORKER_PROCESSES)
+devices = [device.strip() for device in constants.WORKER_DEVICES.split(",") if device.strip()]
+threads = constants.WORKER_THREADS or max(1, (os.cpu_count() or 1) // processes)
+workers = [WorkerProcess(index, worker_env(index, devices, threads)) for index in range(processes)]
+logger.info(f"Supervising {processes} workers with {threads} threads each"
+            + (f" on {', '.join(devices)}" if devices else ""))
+
+drain_deadline = None
+
+def drain(signum, frame):
+    global drain_deadline
+    if drain_deadline is not None:
+        return
+    logger.info(f"Draining workers, waiting up to {constants.WORKER_DRAIN_SECONDS} seconds")
+    drain_deadline = time.time() + constants.WORKER_DRAIN_SECONDS
+    for worker in workers:
+        worker.signal(signal.SIGTERM)
+
+signal.signal(signal.SIGTERM, drain)
+signal.signal(signal.SIGINT, drain)
+
+while True:
+    draining = drain_deadline is not None
+    running = [worker.poll(draining) for worker in workers]
+    if not any(running):
+        break
+    if draining and time.time() > drain_deadline:
+        # Leases of the photos still in hand expire and go back to the queue
+        logger.error("Workers did not drain in time, killing them")
+        for worker in workers:
+            worker.signal(signal.SIGKILL)
+        drain_deadline = float("inf")
+    time.sleep(1)
+
+logger.info("All workers exited")
+sys.exit(constants.CONFIG_ERROR_EXIT_CODE if any(worker.failed for worker in workers) else 0)
@@ -1,9 +1,54 @@
+import os
 import constants
 import requests
+import tempfile
+import threading
 import logging
+from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    """
+    Shared HTTP session for all PhotoPrism calls.
+
+    Connections are kept alive in a pool of HTTP_POOL_SIZE connections, and
+    requests answered with 429 or 5xx are retried with exponential backoff.
+    The session only holds the connection pool, which is thread safe, so it
+    is shared by every thread of the worker.
+
+    Returns:
+        Session: The shared requests session.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=constants.HTTP_RETRIES,
+                backoff_factor=constants.HTTP_BACKOFF,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET", "PUT"],
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=constants.HTTP_POOL_SIZE,
+                pool_maxsize=constants.HTTP_POOL_SIZE,
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+def _timeout():
+    return (constants.HTTP_CONNECT_TIMEOUT, constants.HTTP_READ_TIMEOUT)
+
 def get_photos(json_payload, headers=None):
     """
     Makes a GET request to the given API URL with a JSON payload.
@@ -19,7 +64,7 @@ def get_photos(json_payload, headers=None):
     try:
         # Make the GET request with JSON payload
         api_url = f"{constants.PHOTOPRISM_ROOT_URL}{constants.PHOTOPRISM_PHOTO_API}"
-        response = requests.get(api_url, headers=headers, params=json_payload)
+        response = get_session().get(api_url, headers=headers, params=json_payload, timeout=_timeout())
 
         # Raise an exception for HTTP errors
         response.raise_for_status()
@@ -30,26 +75,218 @@ def get_photos(json_payload, headers=None):
         logger.error(f"An error occurred while getting photo details: {e}")
         return None
         
-def download_image(token, hash, save_path, headers=None):
+# Thumbnail sizes rendered by PhotoPrism that keep the aspect ratio, by longest side
+THUMBNAIL_SIZES = [
+    (720, "fit_720"),
+    (1280, "fit_1280"),
+    (1600, "fit_1600"),
+    (1920, "fit_1920"),
+    (2048, "fit_2048"),
+    (2560, "fit_2560"),
+    (3840, "fit_3840"),
+    (4096, "fit_4096"),
+    (7680, "fit_7680"),
+]
+
+# Listing orders sorted newest first on a photo field, and that field
+SORT_KEYS = {"added": "CreatedAt", "updated": "UpdatedAt", "newest": "TakenAt"}
+
+def photo_pages(json_payload, page_size, offset=0, headers=None):
     """
-    Download an image from PhotoPrism.
+    Page through the photo listing from offset.
+
+    The API only pages by offset, so for orders in SORT_KEYS the listing is
+    walked keyset style: every page after the first starts one photo early,
+    on the last photo yielded (the cursor), and only photos sorting after
+    the cursor are yielded. Photos added in front of the cursor during the
+    walk therefore cannot be yielded twice, and when photos removed in front
+    of it pull the listing past the cursor, the page is requested again from
+    further back instead of skipping photos.
+
+    Args:
+        json_payload (dict): Listing filter, without count and offset.
+        page_size (int): Number of photos per request.
+        offset (int): Offset of the first photo.
+        headers (dict): Optional HTTP headers to include in the requests.
+
+    Yields:
+        tuple: (response, photos) per page, (None, None) once on error.
+    """
+    key = SORT_KEYS.get(json_payload.get("order"))
+    cursor = None
+    # UIDs yielded with the sort value of the cursor, ties are not ordered by UID
+    seen = set()
+    while True:
+        overlap = 1 if key and cursor is not None and offset > 0 else 0
+        start = offset - overlap
+        response = get_photos({**json_payload, "count": page_size + overlap, "offset": start}, headers)
+        if not response:
+            logger.error(f"Error while listing photos at offset {start}")
+            yield None, None
+            return
+        fetched = response.json()
+        if len(fetched) == 0:
+            return
+
+        photos = [(photo, None) for photo in fetched]
+        if key:
+            try:
+                photos = [(photo, _sort_value(photo, key)) for photo in fetched]
+            except (KeyError, TypeError, ValueError):
+                logger.warning(f"Photos without a valid {key}, listing by offset only")
+                key = None
+        if overlap and key:
+            if photos[0][1] < cursor and start > 0:
+                # The listing moved up past the cursor, look further back
+                offset = max(1, offset - page_size)
+                continue
+            photos = [
+                (photo, value) for photo, value in photos
+                if value < cursor or (value == cursor and photo["UID"] not in seen)
+            ]
+        offset = start + len(fetched)
+        # A short page is the end of the listing
+        last = len(fetched) < page_size + overlap
+        if not photos:
+            if last:
+                return
+            continue
+
+        if key:
+            if photos[-1][1] != cursor:
+                cursor, seen = photos[-1][1], set()
+            seen.update(photo["UID"] for photo, value in photos if value == cursor)
+        yield response, [photo for photo, _ in photos]
+        if last:
+            return
+
+def _sort_value(photo, key):
+    # Timestamps do not always have the same number of fractional digits, compare them parsed
+    return datetime.fromisoformat(photo[key].replace("Z", "+00:00"))
+
+def thumbnail_size(min_size):
+    """
+    Pick the smallest PhotoPrism thumbnail at least min_size pixels on its longest side.
+
+    Returns:
+        str: Thumbnail size name, e.g. 'fit_1280'.
+    """
+    for size, name in THUMBNAIL_SIZES:
+        if size >= min_size:
+            return name
+    return THUMBNAIL_SIZES[-1][1]
+
+def image_token(response):
+    """
+    Get the token needed to fetch images from a photo listing response.
+
+    Returns:
+        str: X-Preview-Token when thumbnails are used, X-Download-Token otherwise.
+    """
+    if constants.IMAGE_SOURCE == 'thumbnail':
+        return response.headers.get("X-Preview-Token")
+    return response.headers.get("X-Download-Token")
+
+def get_image_token(headers=None):
     """
+    Get an image token without listing the library.
+
+    Returns:
+        str: The token returned by image_token, or None on error.
+    """
+    response = get_photos({"count": 1, "offset": 0}, headers)
+    if response is None:
+        return None
+    return image_token(response)
+
+def _get_image(token, hash, size, headers):
+    # Stream either a thumbnail of the given size or the original file
+    if size:
+        thumb_api = constants.PHOTOPRISM_THUMB_API.format(hash=hash, token=token, size=size)
+        return get_session().get(f"{constants.PHOTOPRISM_ROOT_URL}{thumb_api}",
+                                 headers=headers, stream=True, timeout=_timeout())
     download_url = f"{constants.PHOTOPRISM_ROOT_URL}{constants.PHOTOPRISM_DL_API.format(hash=hash)}"
-    
+    return get_session().get(download_url, params={"t": token}, headers=headers, stream=True, timeout=_timeout())
+
+def download_image(token, hash, save_path, headers=None, size=None):
+    """
+    Download an image from PhotoPrism.
+
+    Args:
+        token (str): Token returned by image_token.
+        hash (str): File hash of the photo.
+        save_path (str): Where to write the image.
+        headers (dict): Optional HTTP headers to include in the request.
+        size (str): Thumbnail size to fetch instead of the original file, e.g. 'fit_1280'.
+
+    Returns:
+        bool: True if the image was saved.
+    """
     try:
-        response = requests.get(download_url, params={"t": token}, headers=headers, stream=True)
-        response.raise_for_status()
+        response = _get_image(token, hash, size, headers)
+        with response:
+            response.raise_for_status()
 
-        # Save the image locally
-        with open(save_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                file.write(chunk)
+            # Save the image locally
+            with open(save_path, "wb") as file:
+                for chunk in response.iter_content(chunk_size=8192):
+                    file.write(chunk)
 
         return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"An error occurred while downloading image {photo_uid}: {e}")
+        logger.error(f"An error occurred while downloading image {hash}: {e}")
+        # Do not leave a partial file behind
+        if os.path.exists(save_path):
+            os.remove(save_path)
         return False
 
+def download_image_buffer(token, hash, max_memory, headers=None, size=None):
+    """
+    Download an image from PhotoPrism into memory.
+
+    The image is kept in memory up to max_memory bytes and spills over to a
+    temporary file in TEMP_PHOTO_DIR beyond that. Either way nothing is left
+    on disk once the buffer is closed. size works as in download_image.
+
+    Returns:
+        SpooledTemporaryFile: Buffer positioned at the start of the image, or None on error.
+    """
+    buffer = tempfile.SpooledTemporaryFile(max_size=max_memory, dir=constants.TEMP_PHOTO_DIR)
+    
+    try:
+        response = _get_image(token, hash, size, headers)
+        with response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=65536):
+                buffer.write(chunk)
+        
+        buffer.seek(0)
+        return buffer
+    except requests.exceptions.RequestException as e:
+        logger.error(f"An error occurred while downloading image {hash}: {e}")
+        buffer.close()
+        return None
+
+def get_photo(photo_uid, headers=None):
+    """
+    Get the details of a single photo.
+
+    Args:
+        photo_uid (str): UID of the photo.
+        headers (dict): Optional HTTP headers to include in the request.
+
+    Returns:
+        Response: The response object from the request, None on error.
+    """
+    try:
+        api_url = f"{constants.PHOTOPRISM_ROOT_URL}{constants.PHOTOPRISM_PHOTO_API}/{photo_uid}"
+        response = get_session().get(api_url, headers=headers, timeout=_timeout())
+        response.raise_for_status()
+        return response
+    except requests.exceptions.RequestException as e:
+        logger.error(f"An error occurred while getting photo {photo_uid}: {e}")
+        return None
+
 def update_photo_detail(photo_uid, json_payload, headers=None):
     """
     Makes a GET request to the given API URL with a JSON payload.
@@ -64,7 +301,7 @@ def update_photo_detail(photo_uid, json_payload, headers=None):
     try:
         # Make the POST request with JSON payload
         api_url = f"{constants.PHOTOPRISM_ROOT_URL}{constants.PHOTOPRISM_PHOTO_API}/{photo_uid}"
-        response = requests.put(api_url, headers=headers, json=json_payload)
+        response = get_session().put(api_url, headers=headers, json=json_payload, timeout=_timeout())
 
         # Raise an exception for HTTP errors
         response.raise_for_status()
@@ -1,10 +1,20 @@
 import os
 import sys
+import time
+import signal
+import asyncio
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import utils
+import metrics
 import constants
-from detection import Kosmos2DescriptionGenerator, Florence2DescriptionGenerator, Classifier
 from job_queue import PhotoProcessor
-from PIL import Image
+from pipeline import Pipeline, Stage, prefetch
+from async_client import AsyncPhotoPrismClient
+from result_cache import ResultCache, NearDuplicateIndex
+from preprocess import Preprocessor, prepare_inputs, master_size
+import numpy as np
 
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -14,27 +24,137 @@ headers = {
     "X-Auth-Token": constants.PHOTOPRISM_TOKEN,
 }
 
-# Set batch size and initialize the photo processor
-count = 50
+# Fork the preprocessing pool first, before models and threads, including the
+# metrics server's, make this process heavy or unsafe to fork
+preprocessor = None
+if constants.PREPROCESS_WORKERS > 0:
+    preprocessor = Preprocessor(constants.PREPROCESS_WORKERS)
+
+if constants.METRICS_PORT:
+    metrics.serve(constants.METRICS_PORT, constants.METRICS_HOST)
+
+# Initialize the photo processor
 processor = PhotoProcessor(worker_id=constants.NODE_NAME)
+# Keep leases of in-flight photos alive and hand expired ones from dead workers back to the queue
+processor.start_lease_keeper()
 
-# Select the appropriate caption generator based on configuration
-if constants.CAPTION_MODEL == "florence2":
-    caption_processor = Florence2DescriptionGenerator()
-elif constants.CAPTION_MODEL == "kosmos2":
-    caption_processor = Kosmos2DescriptionGenerator()
-else:
+profiles = constants.GENERATION_PROFILES.get(constants.CAPTION_MODEL, {})
+if profiles and constants.CAPTION_PROFILE not in profiles:
+    logger.error(f"Invalid caption profile {constants.CAPTION_PROFILE}, expected one of {', '.join(profiles)}")
+    sys.exit(constants.CONFIG_ERROR_EXIT_CODE)
+
+if constants.CAPTION_MODEL not in ("florence2", "kosmos2"):
     logger.error(f"Invalid caption model {constants.CAPTION_MODEL}")
-    sys.exit(-1)
+    sys.exit(constants.CONFIG_ERROR_EXIT_CODE)
+
+# Classification runs on its own thread, concurrently with caption generation
+classify_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="classify")
+# The updates of a batch are sent concurrently
+update_executor = ThreadPoolExecutor(max_workers=max(1, constants.UPDATE_CONCURRENCY), thread_name_prefix="update")
+
+# With adaptive batching, photos are gathered up to the largest batch and the
+# caption generator splits them into chunks of the size it settled on
+caption_batch_size = constants.CAPTION_MAX_BATCH_SIZE if constants.ADAPTIVE_BATCH else constants.CAPTION_BATCH_SIZE
+# Without the pipeline photos are decoded in groups holding a full batch of either model
+inference_batch_size = max(caption_batch_size, constants.CLASSIFY_BATCH_SIZE)
 
-# Initialize the classifier for label detection
-yolo_processor = Classifier()
+# Results are cached per model, a change to one model only re-runs that model
+result_cache = None
+if constants.RESULT_CACHE:
+    result_cache = ResultCache(constants.RESULT_CACHE_PATH, constants.RESULT_CACHE_MAX_ENTRIES)
+
+# Recent results per model by perceptual hash, reused for near-identical photos
+near_duplicates = None
+if constants.NEAR_DUPLICATE:
+    near_duplicates = {
+        model: NearDuplicateIndex(constants.NEAR_DUPLICATE_DISTANCE, constants.NEAR_DUPLICATE_INDEX_SIZE)
+        for model in ('caption', 'classify')
+    }
+
+# The models and everything derived from them are set up by load_models once
+# the first photos are acquired, a run with nothing to do never loads them
+caption_processor = None
+yolo_processor = None
+model_specs = None
+thumbnail = None
+draft_size = None
+caption_cache_key = None
+label_cache_key = None
+models_lock = threading.Lock()
+
+def remote_models():
+    """
+    Clients of the model server at MODEL_SERVER_URL, (None, None) when it is
+    not set or cannot be reached.
+    """
+    if not constants.MODEL_SERVER_URL:
+        return None, None
+    from model_client import RemoteDescriptionGenerator, RemoteClassifier
+    try:
+        return RemoteDescriptionGenerator(constants.MODEL_SERVER_URL), RemoteClassifier(constants.MODEL_SERVER_URL)
+    except Exception as e:
+        logger.warning(f"Model server {constants.MODEL_SERVER_URL} is not available, loading the models locally: {e}")
+        return None, None
+
+def load_models():
+    global caption_processor, yolo_processor, model_specs, thumbnail, draft_size, caption_cache_key, label_cache_key
+    with models_lock:
+        if caption_processor is not None:
+            return
+        
+        start_time = time.time()
+        captioner, classifier = remote_models()
+        if captioner is None:
+            # Imported on first use, importing torch alone takes seconds
+            from detection import Kosmos2DescriptionGenerator, Florence2DescriptionGenerator, Classifier
+            # Select the appropriate caption generator based on configuration
+            if constants.CAPTION_MODEL == "florence2":
+                captioner = Florence2DescriptionGenerator()
+            else:
+                captioner = Kosmos2DescriptionGenerator()
+            # Initialize the classifier for label detection
+            classifier = Classifier()
+        
+        # Smallest image resolution that still satisfies every model
+        input_size = max(captioner.input_size, classifier.input_size)
+        if constants.IMAGE_SOURCE == 'thumbnail':
+            thumbnail = constants.THUMBNAIL_SIZE or utils.thumbnail_size(input_size)
+            logger.info(f"Using PhotoPrism thumbnails of size {thumbnail}")
+        draft_size = input_size if constants.DECODE_DRAFT else None
+        
+        # Every photo is decoded once into a master downscaled to master_size(model_specs)
+        # and the input of each model is derived from that master
+        model_specs = {
+            'caption': captioner.preprocess_spec(),
+            'classify': classifier.preprocess_spec(),
+        }
+        logger.info(f"Decoding photos into masters of {master_size(model_specs)}px shortest edge")
+        
+        caption_cache_key = (captioner.model_name, captioner.model_version,
+                             f"{constants.CAPTION_PROFILE}/{constants.CAPTION_BACKEND}")
+        label_cache_key = (classifier.model_name, classifier.model_version,
+                           f"{constants.YOLO_BACKEND}/{constants.YOLO_CONFIDENCE}")
+        yolo_processor = classifier
+        # Set last, other threads wait on the lock until everything above is ready
+        caption_processor = captioner
+        logger.info(f"Models loaded in {time.time() - start_time:.2f} seconds")
 
 if constants.CLEANUP:
     # Clean up stale tasks if enabled
     processor.cleanup_stale_tasks(constants.CLEANUP_STALE_HOURS)
     logger.info(f"Cleaned up stale tasks older than {constants.CLEANUP_STALE_HOURS} hours")
     
+# A re-pass puts the photos captioned with REPASS_PROFILE back in the queue and
+# scans captioned photos too, as every photo it targets already has a caption
+full_scan = constants.FULL_SCAN
+if constants.REPASS_PROFILE:
+    requeued = processor.requeue_profile(constants.REPASS_PROFILE)
+    if requeued < 0:
+        logger.error("Error requeueing photos for the re-pass, please check your database connection")
+        sys.exit(-1)
+    logger.info(f"Requeued {requeued} photos captioned with profile {constants.REPASS_PROFILE} for profile {constants.CAPTION_PROFILE}")
+    full_scan = True
+    
 offset = 0
 if constants.RESUME:
     offset = processor.get_finish_job_count()
@@ -46,133 +166,629 @@ if constants.RESUME:
         offset = 0
     logger.info(f"Resuming from offset {offset}")
 
-# Main processing loop
-while True:
-    # Prepare the payload for fetching photos
-    json_payload = {
-        "count": count,
-        "offset": offset,
-        "order": "added",
-        "photo": True,
-        "primary": True,
-    }
+def merge_keywords(keywords, labels):
+    """Append labels to a comma separated keyword list, dropping empty and duplicate keywords"""
+    merged, seen = [], set()
+    for keyword in (keywords or '').split(',') + list(labels):
+        keyword = keyword.strip()
+        if keyword and keyword.lower() not in seen:
+            seen.add(keyword.lower())
+            merged.append(keyword)
+    return ','.join(merged)
+
+def update_photo(photo, caption, label):
+    """
+    Write the caption and append the labels to the keywords of a photo, in a
+    single update. PhotoPrism search results do not include the photo
+    details, so the existing keywords are read with a GET of the photo first,
+    a photo costs a GET and a PUT.
+
+    Returns:
+        bool: True if the update succeeded.
+    """
+    with metrics.stage_seconds.time(stage="update"):
+        photo_uid = photo['UID']
+        photo_response = utils.get_photo(photo_uid, headers)
+        if not photo_response:
+            return False
+        details = photo_response.json().get('Details') or {}
     
-    # Fetch photo details from the API
-    photo_response = utils.get_photos(json_payload, headers)
-    logger.info(f"Successfully got photo details with offset {offset}")
+        keywords = merge_keywords(details.get('Keywords'), label)
+        request_data = {
+            "Caption": caption,
+            "CaptionSrc": "manual",
+            "Details": {
+                "Keywords": keywords,
+                "KeywordsSrc": "manual",
+            },
+        }
+        logger.debug(f"Updated keywords for {photo_uid}: {keywords}")
     
-    if photo_response:
-        token = photo_response.headers["X-Download-Token"]
-        photos = photo_response.json()
+        update_response = utils.update_photo_detail(photo_uid, request_data, headers)
+        if not update_response:
+            return False
+        logger.info(f"Updated caption and keywords for {photo_uid}")
+        return True
+
+def remove_temp_file(save_path):
+    # Remove the temporary photo file
+    if save_path and os.path.exists(save_path):
+        try:
+            os.remove(save_path)
+        except Exception as e:
+            logger.error(f"Error removing file {save_path}: {e}")
+
+def listed_pages(offset):
+    """
+    Page through the PhotoPrism library from offset and yield (photos, download token)
+    for every page, keeping only the photos this worker managed to acquire.
+    """
+    global listing_failed
+    for photo_response, photos in utils.photo_pages(constants.PHOTO_FILTER, constants.PAGE_SIZE, offset, headers):
+        if photo_response is None:
+            logger.error("Error while listing photos, will stop here")
+            listing_failed = True
+            return
+        if stopping.is_set():
+            logger.info("Draining, no more photos will be taken on")
+            return
+        logger.info(f"Successfully got {len(photos)} photo details")
         
-        # Stop processing if no photos are returned
-        if len(photos) == 0:
-            logger.info("No more photos to process, will stop here")
-            break
+        token = utils.image_token(photo_response)
+        finished = False
+        for idx, photo in enumerate(photos):
+            if not full_scan and photo['Caption']:
+                logger.info(f"Photo {photo['UID']} already has caption, assuming all complete, if not, please re-run with env var FULL_SCAN=1")
+                photos = photos[:idx]
+                finished = True
+                break
         
-        # Process photos in batches
-        for i in range(0, len(photos), constants.CAPTION_BATCH_SIZE):
-            end = i + constants.CAPTION_BATCH_SIZE
-            if end > len(photos):
-                end = None
-            batch = photos[i:end]
-            batch_data = []
-            stop_signal = False
-            
-            # Process each photo in the batch
-            for photo in batch:
-                photo_uid = photo['UID']
-                
-                # Skip photos that already have captions unless FULL_SCAN is enabled
-                if not constants.FULL_SCAN and photo['Caption']:
-                    logger.info(f"Photo {photo_uid} already has caption, assuming all complete, if not, please re-run with env var FULL_SCAN=1")
-                    sys.exit(0)
-                
-                # Try to acquire the photo for processing
-                status = processor.try_acquire_photo(photo_uid)
-                if not status:
-                    # Photo is already being processed by another worker
-                    continue
-            
-                # Download the photo
-                photo_hash = photo['Hash']
-                filename = os.path.basename(photo['FileName'])
-                save_path = os.path.join(constants.TEMP_PHOTO_DIR, filename)
-                status = utils.download_image(token, photo_hash, save_path, headers)
-                if not status:
-                    stop_signal = True
-                    processor.mark_complete(photo_uid, "Error")
-                    break
-                logger.info(f"Image {photo_uid} downloaded and saved to: {save_path}")
-                batch_data.append((photo_uid, save_path))
-                
-            # Skip further processing if there was an error or no valid batch data
-            if stop_signal or not batch_data:
+        if constants.INCREMENTAL:
+            # Record the Hash of every photo so later syncs can tell replaced files apart
+            processor.seed_tasks(photos)
+        acquired = set(processor.try_acquire_photos([photo['UID'] for photo in photos], photos))
+        yield [photo for photo in photos if photo['UID'] in acquired], token
+        
+        if finished:
+            return
+    logger.info("No more photos to process, will stop here")
+
+def updated_photos(since):
+    """
+    List every photo updated since the given time, up front, before any of
+    them is processed and updated again.
+
+    Returns:
+        tuple: The photos and the download token, (None, None) on error.
+    """
+    json_payload = {
+        **constants.PHOTO_FILTER,
+        "order": "updated",
+        "updated": since.strftime("%Y-%m-%dT%H:%M:%SZ"),
+    }
+    photos, token = [], None
+    for photo_response, page in utils.photo_pages(json_payload, constants.PAGE_SIZE, headers=headers):
+        if photo_response is None:
+            logger.error(f"Error while listing photos updated since {since}, will stop here")
+            return None, None
+        token = utils.image_token(photo_response)
+        photos.extend(page)
+    return photos, token
+
+def synced_pages(photos, token):
+    """
+    Yield (photos, download token) pages of the updated photos that need
+    captioning: uncaptioned photos, photos whose file was replaced since they
+    were processed, and every photo with FULL_SCAN.
+    """
+    replaced = set(processor.replaced_tasks(photos))
+    if replaced:
+        logger.info(f"{len(replaced)} photos have a new file since they were processed")
+    processor.seed_tasks(photos)
+    for start in range(0, len(photos), constants.PAGE_SIZE):
+        if stopping.is_set():
+            logger.info("Draining, no more photos will be taken on")
+            return
+        page = [
+            photo for photo in photos[start:start + constants.PAGE_SIZE]
+            if full_scan or not photo['Caption'] or photo['UID'] in replaced
+        ]
+        acquired = set(processor.try_acquire_photos([photo['UID'] for photo in page], page))
+        yield [photo for photo in page if photo['UID'] in acquired], token
+
+def claimed_pages(retries=False):
+    """
+    Claim pending tasks seeded by seed.py straight from the job database and
+    yield (photos, download token) for every claim. With retries, only failed
+    tasks due for a retry are claimed.
+    """
+    while not stopping.is_set():
+        photos = processor.claim_tasks(constants.QUEUE_CLAIM_SIZE, include_captioned=full_scan, retries=retries)
+        if not photos:
+            if retries:
+                logger.info("No failed photos due for a retry")
+            else:
+                logger.info("No more pending tasks in the queue, will stop here")
+            return
+        if retries:
+            logger.info(f"Retrying {len(photos)} failed photos")
+        else:
+            logger.info(f"Claimed {len(photos)} tasks from the queue")
+        
+        token = utils.get_image_token(headers)
+        if not token:
+            logger.error("Error getting image token, will stop here")
+            processor.release_tasks([photo['UID'] for photo in photos])
+            return
+        
+        yield photos, token
+    logger.info("Draining, no more tasks will be claimed")
+
+def retried_pages(pages):
+    """
+    Yield the pages, then the failed photos due for a retry: listings and syncs
+    only see the photos they list, a failed photo may not be listed again.
+    """
+    yield from pages
+    if not listing_failed:
+        yield from claimed_pages(retries=True)
+
+def cached_jobs(photos, token):
+    """
+    Job dicts of a page of photos, with the caption and labels already filled
+    in for the photos whose results are in the result cache.
+    """
+    if photos:
+        load_models()
+    jobs = [{'uid': photo['UID'], 'photo': photo, 'token': token} for photo in photos]
+    metrics.photos_acquired.inc(len(jobs))
+    if result_cache:
+        hashes = [photo.get('Hash') for photo in photos]
+        captions = result_cache.get_many(*caption_cache_key, hashes)
+        labels = result_cache.get_many(*label_cache_key, hashes)
+        for job in jobs:
+            job['caption'] = captions.get(job['photo'].get('Hash'))
+            job['label'] = labels.get(job['photo'].get('Hash'))
+        cached = sum(1 for job in jobs if not missing_models(job))
+        if cached:
+            logger.info(f"Reusing cached results for {cached} of {len(jobs)} photos")
+    return jobs
+
+def jobs_of(pages):
+    # Flatten pages into job dicts
+    for photos, token in pages:
+        yield from cached_jobs(photos, token)
+
+# Model name and the job key its result is stored under
+MODEL_RESULTS = (('caption', 'caption'), ('classify', 'label'))
+
+def missing_models(job):
+    # Models whose result for the photo is not known yet
+    return [name for name, key in MODEL_RESULTS if job.get(key) is None]
+
+def batches(source, size):
+    # Group the items of source into lists of at most size items
+    batch = []
+    for item in source:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def temp_path(photo):
+    # Prefix with the UID, photos in different folders can share a file name
+    return os.path.join(constants.TEMP_PHOTO_DIR, f"{photo['UID']}_{os.path.basename(photo['FileName'])}")
+
+def download_photo(photo, token):
+    """
+    Download a photo into memory when IN_MEMORY_DOWNLOAD is enabled, to a file in TEMP_PHOTO_DIR otherwise.
+
+    Returns:
+        The buffer or file path to decode the photo from, or None on error.
+    """
+    with metrics.stage_seconds.time(stage="download"):
+        if constants.IN_MEMORY_DOWNLOAD:
+            return utils.download_image_buffer(token, photo['Hash'], constants.IN_MEMORY_MAX_BYTES, headers, thumbnail)
+        save_path = temp_path(photo)
+        if utils.download_image(token, photo['Hash'], save_path, headers, thumbnail):
+            return save_path
+        return None
+
+def release_download(source):
+    # Close the download buffer or remove the downloaded file
+    if source is None:
+        return
+    if isinstance(source, str):
+        remove_temp_file(source)
+    else:
+        source.close()
+
+def decode_download(source, specs, phash=False):
+    """
+    Decode a downloaded photo, the download is released whether decoding succeeds or not.
+
+    Returns:
+        dict: Input of every model of specs, see preprocess.prepare_inputs.
+    """
+    try:
+        with metrics.stage_seconds.time(stage="decode"):
+            if preprocessor:
+                return preprocessor.prepare(source, specs, draft_size, phash)
+            return prepare_inputs(source, specs, draft_size, phash)
+    finally:
+        release_download(source)
+
+# Pipeline stages, each one takes and returns a job dict describing a single photo,
+# photos whose results are all cached go through every stage untouched
+def download_stage(job):
+    if not missing_models(job):
+        return job
+    job['source'] = download_photo(job['photo'], job['token'])
+    if job['source'] is None:
+        raise RuntimeError(f"Download of {job['uid']} failed")
+    logger.info(f"Image {job['uid']} downloaded")
+    return job
+
+def decode_specs(job):
+    # Inputs to decode the photo into, one per model still missing its result
+    return {name: model_specs[name] for name in missing_models(job)}
+
+def decode_stage(job):
+    if 'source' in job:
+        job['image'] = decode_download(job.pop('source'), decode_specs(job), phash=near_duplicates is not None)
+        reuse_near_duplicate(job)
+    return job
+
+def decode_batch(jobs):
+    """
+    Decode the downloaded photos of a batch, failing only the photos that
+    cannot be decoded. With a preprocessor pool every photo of the batch is
+    submitted before any is waited on, so the pool decodes them in parallel.
+
+    Returns:
+        list: The jobs that did not fail.
+    """
+    submitted = {}
+    if preprocessor:
+        for job in jobs:
+            if 'source' not in job:
                 continue
-                
-            # Generate captions for the batch of images
-            images = []
-            for photo_uid, save_path in batch_data:
+            try:
+                submitted[job['uid']] = preprocessor.submit(job['source'], decode_specs(job), draft_size,
+                                                            near_duplicates is not None)
+            except Exception as e:
+                logger.error(f"Error opening image {job['uid']}: {e}")
+                fail_job(job, e)
+    
+    decoded = []
+    for job in jobs:
+        if 'error' in job:
+            continue
+        try:
+            if job['uid'] in submitted:
                 try:
-                    images.append(Image.open(save_path).convert("RGB"))
-                except Exception as e:
-                    logger.error(f"Error opening image {save_path}: {e}")
-                    processor.mark_complete(photo_uid, "Error")
-                    # remove task from batch_data
-                    batch_data.remove((photo_uid, save_path))
-                    
-            captions = caption_processor.generate(images)
-            if not captions:
-                for photo_uid, _ in batch_data:
-                    processor.mark_complete(photo_uid, "Error")
-                continue
-            logger.info(f"Generated caption for {', '.join([photo_uid for photo_uid, _ in batch_data])}")
-            
-            # Classify images to detect labels
-            labels = yolo_processor.classify(images)
-            logger.info(f"Detected labels for {', '.join([photo_uid for photo_uid, _ in batch_data])}")
-            
-            # Update photo details with captions and labels
-            for data, caption, label in zip(batch_data, captions, labels):
-                photo_uid, save_path = data
-                request_data = {
-                    "Caption": caption,
-                    "CaptionSrc": "manual",
-                }
-                update_response = utils.update_photo_detail(photo_uid, request_data, headers)
-                
-                if update_response:
-                    logger.info(f"Updated caption for {photo_uid}")
-                    detail = update_response.json()['Details']
-                    
-                    # Append new labels to existing keywords
-                    keywords = ','.join(detail['Keywords'].split(',') + label)
-                    detail['Keywords'] = keywords
-                    detail['KeywordsSrc'] = "manual"
-                    
-                    request_data = {
-                        "Details": detail,
-                    }
-                    logger.debug(f"Updated keywords for {photo_uid}: {keywords}")
-                    
-                    update_response = utils.update_photo_detail(photo_uid, request_data, headers)
-                    if update_response:
-                        logger.info(f"Updated keywords for {photo_uid}")
-                        processor.mark_complete(photo_uid)
-                        logger.info(f"Marked photo {photo_uid} complete")
-                        
-                        # Remove the temporary photo file
-                        if os.path.exists(save_path):
-                            try:
-                                os.remove(save_path)
-                            except Exception as e:
-                                logger.error(f"Error removing file {save_path}: {e}")
+                    with metrics.stage_seconds.time(stage="decode"):
+                        job['image'] = preprocessor.collect(submitted[job['uid']])
+                finally:
+                    release_download(job.pop('source'))
+                reuse_near_duplicate(job)
+            else:
+                decode_stage(job)
+            decoded.append(job)
+        except Exception as e:
+            logger.error(f"Error opening image {job['uid']}: {e}")
+            fail_job(job, e)
+    return decoded
+
+def reuse_near_duplicate(job):
+    # Fill in the results of a recent near-identical photo, the models then skip this photo
+    if near_duplicates is None:
+        return
+    job['phash'] = int(job['image'].pop('phash')[0])
+    reused = []
+    for model, key in MODEL_RESULTS:
+        result = near_duplicates[model].find(job['phash']) if model in job['image'] else None
+        if result is not None:
+            job[key] = result
+            del job['image'][model]
+            metrics.near_duplicates.inc(model=model)
+            reused.append(model)
+    if reused:
+        logger.info(f"Reusing {' and '.join(reused)} results of a near-duplicate for {job['uid']}")
+
+def observe_batch(model, size, seconds):
+    # Latency and size of a model batch, in the metrics and the batch records
+    metrics.stage_seconds.observe(seconds, stage=model)
+    metrics.batch_size.observe(size, model=model)
+    metrics.record_batch(stage=model, photos=size, seconds=round(seconds, 3))
+
+def complete_jobs(completed, failed, seconds):
+    # Count and record a written back batch
+    metrics.photos_completed.inc(len(completed))
+    metrics.photos_failed.inc(len(failed))
+    metrics.record_batch(stage="update", photos=len(completed) + len(failed), completed=len(completed),
+                         failed=len(failed), seconds=round(seconds, 3))
+
+def bisect_batch(run, pixel_values):
+    """
+    Run a model on a batch, splitting the batch in halves whenever it fails
+    until the photos that fail on their own are isolated, so one bad photo
+    does not fail the photos batched with it.
+
+    Args:
+        run: Model call taking stacked pixel values, returning one result per photo or None/[] on error.
+        pixel_values (ndarray): Stacked model inputs.
+
+    Returns:
+        list: One result per photo, None for the photos that failed on their own.
+    """
+    results = run(pixel_values)
+    if results and len(results) == len(pixel_values):
+        return list(results)
+    if len(pixel_values) == 1:
+        return [None]
+    middle = len(pixel_values) // 2
+    logger.warning(f"Batch of {len(pixel_values)} photos failed, retrying it in halves")
+    return bisect_batch(run, pixel_values[:middle]) + bisect_batch(run, pixel_values[middle:])
+
+def run_model(model, jobs, run, result_key, cache_key):
+    """
+    Run a model on the jobs still missing its result, failing only the photos
+    the model fails on.
+
+    Returns:
+        list: The jobs that did not fail.
+    """
+    todo = [job for job in jobs if model in job.get('image', {})]
+    if not todo:
+        return jobs
+    start_time = time.perf_counter()
+    results = bisect_batch(run, np.stack([job['image'].pop(model) for job in todo]))
+    observe_batch(model, len(todo), time.perf_counter() - start_time)
+    
+    done = {}
+    for job, result in zip(todo, results):
+        if result is None:
+            fail_job(job, RuntimeError(f"{model} failed"))
+        else:
+            job[result_key] = result
+            done[job['photo'].get('Hash')] = result
+            if near_duplicates is not None:
+                near_duplicates[model].add(job['phash'], result)
+    if result_cache and done:
+        result_cache.put_many(*cache_key, done)
+    return [job for job in jobs if 'error' not in job]
+
+def classify_stage(jobs):
+    return run_model('classify', jobs, lambda pixel_values: yolo_processor.classify(pixel_values=pixel_values),
+                     'label', label_cache_key)
+
+def caption_stage(jobs):
+    todo = [job for job in jobs if 'caption' in job.get('image', {})]
+    jobs = run_model('caption', jobs, lambda pixel_values: caption_processor.generate(pixel_values=pixel_values),
+                     'caption', caption_cache_key)
+    generated = [job['uid'] for job in todo if 'error' not in job]
+    if generated:
+        logger.info(f"Generated caption and labels for {', '.join(generated)}")
+    return jobs
+
+def classify_batches(jobs):
+    for batch in batches(jobs, constants.CLASSIFY_BATCH_SIZE):
+        classify_stage(batch)
+
+def inference_stage(jobs):
+    # Classify on the classifier thread while the captions are generated, each
+    # model batching the photos by its own batch size
+    classified = classify_executor.submit(classify_batches, jobs)
+    try:
+        for batch in batches(jobs, caption_batch_size):
+            caption_stage(batch)
+    finally:
+        classified.result()
+    for job in jobs:
+        # Release the decoded pixels as soon as inference is done
+        job.pop('image', None)
+    # Photos failed by either model are left out
+    return [job for job in jobs if 'error' not in job]
+
+def update_stage(jobs):
+    start_time = time.perf_counter()
+    results = update_executor.map(lambda job: update_photo(job['photo'], job['caption'], job['label']), jobs)
+    completed, failed = [], []
+    for job, ok in zip(jobs, results):
+        if ok:
+            completed.append(job['uid'])
+        else:
+            failed.append(job['uid'])
+    processor.mark_complete_many(completed, caption_profile=constants.CAPTION_PROFILE)
+    processor.mark_complete_many(failed, "Error")
+    complete_jobs(completed, failed, time.perf_counter() - start_time)
+    logger.info(f"Marked photos {', '.join(completed)} complete")
+    return None
+
+def fail_job(job, error):
+    """Mark a single photo failed, it is retried later, see PhotoTask.retry_count"""
+    # Both models may fail the same photo at once, it is only failed once
+    if job.setdefault('error', error) is not error:
+        return
+    processor.mark_complete(job['uid'], str(error) or "Error")
+    metrics.photos_failed.inc()
+    release_download(job.pop('source', None))
+
+def run_pipeline(jobs):
+    """
+    Run download, decode, classification, captioning and update as separate
+    stages connected by bounded queues, so network I/O overlaps with inference
+    and the classifier batches photos independently of the caption model.
+    """
+    stages = [
+        Stage("download", download_stage, workers=constants.PIPELINE_DOWNLOAD_WORKERS,
+              queue_size=constants.PIPELINE_QUEUE_SIZE, on_error=fail_job),
+        Stage("decode", decode_stage, workers=constants.PIPELINE_DECODE_WORKERS,
+              queue_size=constants.PIPELINE_QUEUE_SIZE, on_error=fail_job),
+        # Models are not thread safe, each one runs on a single thread of its own
+        Stage("classify", classify_stage, workers=1, batch_size=constants.CLASSIFY_BATCH_SIZE,
+              batch_timeout=constants.PIPELINE_BATCH_TIMEOUT,
+              queue_size=max(constants.PIPELINE_QUEUE_SIZE, constants.CLASSIFY_BATCH_SIZE * 2), on_error=fail_job),
+        Stage("caption", caption_stage, workers=1, batch_size=caption_batch_size,
+              batch_timeout=constants.PIPELINE_BATCH_TIMEOUT,
+              queue_size=max(constants.PIPELINE_QUEUE_SIZE, caption_batch_size * 2), on_error=fail_job),
+        # Waits for a batch like the models, so a caption batch is completed in one transaction
+        Stage("update", update_stage, workers=constants.PIPELINE_UPDATE_WORKERS,
+              queue_size=constants.PIPELINE_QUEUE_SIZE, batch_size=constants.PIPELINE_QUEUE_SIZE,
+              batch_timeout=constants.PIPELINE_BATCH_TIMEOUT, on_error=fail_job),
+    ]
+    Pipeline(stages, stats_interval=constants.PIPELINE_STATS_INTERVAL).run(jobs)
+
+def decode_and_infer(jobs):
+    """Decode and caption a batch of downloaded jobs, failing only the photos that cannot be decoded"""
+    decoded = decode_batch(jobs)
+    if not decoded:
+        return []
+    try:
+        return inference_stage(decoded)
+    except Exception as e:
+        logger.error(f"Error generating captions: {e}")
+        for job in decoded:
+            fail_job(job, e)
+        return []
+
+async def write_back_async(client, jobs):
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*(
+        client.run(update_photo, job['photo'], job['caption'], job['label']) for job in jobs
+    ))
+    completed = [job['uid'] for job, ok in zip(jobs, results) if ok]
+    failed = [job['uid'] for job, ok in zip(jobs, results) if not ok]
+    await asyncio.to_thread(processor.mark_complete_many, completed, None, constants.CAPTION_PROFILE)
+    await asyncio.to_thread(processor.mark_complete_many, failed, "Error")
+    complete_jobs(completed, failed, time.perf_counter() - start_time)
+    logger.info(f"Marked photos {', '.join(completed)} complete")
+
+async def run_async(pages):
+    """
+    Process photos on an asyncio event loop: the next page is fetched while the
+    current one is processed, every download of a page is started at once and
+    write-backs run concurrently, all bounded by ASYNC_IN_FLIGHT requests.
+    """
+    client = AsyncPhotoPrismClient(in_flight=constants.ASYNC_IN_FLIGHT)
+    async for photos, token in client.prefetch(pages):
+        jobs = await asyncio.to_thread(cached_jobs, photos, token)
+        downloads = [asyncio.ensure_future(client.run(download_stage, job)) for job in jobs]
+        
+        updates = []
+        for start in range(0, len(jobs), inference_batch_size):
+            batch = jobs[start:start + inference_batch_size]
+            results = await asyncio.gather(*downloads[start:start + inference_batch_size], return_exceptions=True)
+            ready = []
+            for job, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    logger.error(str(result))
+                    # Failing a photo writes to the job database, off the event loop too
+                    await asyncio.to_thread(fail_job, job, result)
+                else:
+                    ready.append(job)
             
+            # Inference runs off the event loop so downloads and the next page keep going
+            ready = await asyncio.to_thread(decode_and_infer, ready)
+            if ready:
+                updates.append(asyncio.ensure_future(write_back_async(client, ready)))
+        
+        await asyncio.gather(*updates)
+
+def run_serial(jobs):
+    for batch in batches(jobs, inference_batch_size):
+        downloaded = []
+        for job in batch:
+            try:
+                downloaded.append(download_stage(job))
+            except Exception as e:
+                logger.error(str(e))
+                fail_job(job, e)
+        
+        # Decode, caption and classify, photos that fail are marked failed
+        ready = decode_and_infer(downloaded)
+        if ready:
+            update_stage(ready)
+
+def process(pages):
+    if constants.ASYNC_IO:
+        # The async client prefetches pages itself
+        asyncio.run(run_async(pages))
+        return
+    if constants.PAGE_PREFETCH > 0:
+        # List and acquire the next pages while the current one is processed
+        pages = prefetch(pages, constants.PAGE_PREFETCH)
+    if constants.PIPELINE:
+        run_pipeline(jobs_of(pages))
     else:
-        # Log an error and stop processing if the API call fails
-        logger.error(f"Error while processing offset {offset}, will stop here")
-        break
-    
-    # Increment the offset for the next batch
-    offset += count
+        run_serial(jobs_of(pages))
+
+def log_progress():
+    counts = processor.get_status_counts()
+    if counts:
+        logger.info(f"Tasks in the job database: {', '.join(f'{count} {status}' for status, count in sorted(counts.items()))}")
+
+def sync():
+    """
+    Process the photos updated since the high-water mark stored in the job
+    database, then move the mark to the start of this sync. Without a mark,
+    the library is listed like a regular run first.
+    """
+    global listing_failed
+    listing_failed = False
+    started = datetime.utcnow()
+    since = processor.get_sync_mark()
+    if since is False:
+        # Not knowing the mark is not the same as having none, listing the whole library would be wasted
+        logger.error("Error getting the sync mark, skipping this sync")
+        return
+    if since is None:
+        logger.info("No previous sync, listing the library")
+        process(retried_pages(listed_pages(offset)))
+    else:
+        # Step back a little so clock skew with PhotoPrism cannot hide photos
+        since -= timedelta(seconds=constants.SYNC_OVERLAP_SECONDS)
+        photos, token = updated_photos(since)
+        if photos is None:
+            return
+        logger.info(f"{len(photos)} photos updated since {since}")
+        process(retried_pages(synced_pages(photos, token)))
+    # A drained sync did not see every updated photo, the next one starts over from the same mark
+    if not listing_failed and not stopping.is_set():
+        processor.set_sync_mark(started)
+    processor.flush()
+    log_progress()
+
+# SIGTERM, from supervisor.py or docker stop, drains the worker: no more photos
+# are taken on, the ones in hand are finished and written back, then it exits
+stopping = threading.Event()
 
+def drain(signum, frame):
+    logger.info("Received SIGTERM, finishing the photos in hand before exiting")
+    stopping.set()
+
+signal.signal(signal.SIGTERM, drain)
+
+listing_failed = False
+if constants.INCREMENTAL:
+    while not stopping.is_set():
+        sync()
+        if constants.SYNC_INTERVAL <= 0:
+            break
+        logger.info(f"Next sync in {constants.SYNC_INTERVAL} seconds")
+        stopping.wait(constants.SYNC_INTERVAL)
+    if preprocessor:
+        preprocessor.shutdown()
+    sys.exit(0)
+
+if constants.QUEUE_MODE:
+    process(claimed_pages())
+else:
+    process(retried_pages(listed_pages(offset)))
+processor.flush()
+log_progress()
+if preprocessor:
+    preprocessor.shutdown()